@@ -144,7 +144,7 @@ class SurveyAdmin(admin.ModelAdmin):
         ('require_login','allow_multiple_submissions','moderate_submissions','allow_comments','allow_voting',),
         ('starts_at','ends_at',),
         ('archive_policy','is_published',),
-        'email',
+        ('email','email_digest_size','email_digest_minutes',),
         'flickr_group_name',
     ]
     class Media:
@@ -0,0 +1,28 @@
+""" Sets of submission ids as bitmaps. Bit n is set if submission n is in the
+set. Python's long integers do the bitwise work, and zlib shrinks them for
+the cache. """
+import binascii
+import zlib
+
+
+def from_ids(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        bits[id >> 3] |= 1 << (id & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bits), 16)
+
+
+def popcount(bitmap):
+    return bin(bitmap).count("1")
+
+
+def dumps(bitmap):
+    return zlib.compress("%x" % bitmap)
+
+
+def loads(data):
+    return int(zlib.decompress(data), 16)
@@ -0,0 +1,40 @@
+""" Versioned keys for Django's cache backend, so that every process sees the
+same version and a bump invalidates everything cached under the old one. """
+import time
+
+from django.core.cache import cache
+
+from .util import run_commit_hooks
+
+
+# memcached treats anything longer than 30 days as a timestamp.
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def _version_key(name):
+    return "crowdsourcing_version_%s" % name
+
+
+def get_version(name):
+    """ Versions are the time they were bumped, so they also say when
+    whatever they version last changed. If the cache forgot the version, start
+    a new one. """
+    run_commit_hooks()
+    key = _version_key(name)
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(name):
+    version = time.time()
+    cache.set(_version_key(name), version, VERSION_TIMEOUT)
+    return version
+
+
+def versioned_key(name, version, *parts):
+    return "_".join(["crowdsourcing", name, repr(version)] +
+                    [str(p) for p in parts])
@@ -30,8 +30,8 @@ from django.utils.html import strip_tags
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
-from .geo import get_latitude_and_longitude
-from .models import OPTION_TYPE_CHOICES, Answer, Survey, Question, Submission
+from .models import (OPTION_TYPE_CHOICES, Answer, PendingGeocode, Survey,
+                     Question, Submission)
 from .settings import VIDEO_URL_PATTERNS, IMAGE_UPLOAD_PATTERN
 from .util import get_session, get_user
 
@@ -42,6 +42,13 @@ except ImportError:
 
 
 class BaseAnswerForm(Form):
+    # True for classes from compile_question_form, whose fields are already
+    # configured for their question.
+    compiled = False
+    # When save(commit=False) sets this, the submission's old answers to the
+    # question should go when the new ones are saved.
+    replaces_answers = False
+
     def __init__(self,
                  question,
                  session_key,
@@ -52,7 +59,8 @@ class BaseAnswerForm(Form):
         self.session_key = session_key
         self.submission = submission
         super(BaseAnswerForm, self).__init__(*args, **kwargs)
-        self._configure_answer_field()
+        if not self.compiled:
+            self._configure_answer_field()
         self.populate_from_submission()
 
 
@@ -90,8 +98,10 @@ class BaseAnswerForm(Form):
         # dont wind up recording answers multiple times for the same question
         # in the same submission (which can happen for surveys where it is enabled
         # to resubmit the survey (change your answers)
-        if self.submission:
-            self.submission.get_question_answers(self.question).delete()
+        self.replaces_answers = bool(self.submission)
+        if commit and self.submission:
+            Answer.delete_answers(
+                self.submission.answer_set.filter(question=self.question))
         ans = Answer()
         if self.submission:
             ans.submission = self.submission
@@ -178,17 +188,32 @@ class LocationAnswer(BaseAnswerForm):
 
     def save(self, commit=True):
         obj = super(LocationAnswer, self).save(commit=False)
+        if obj is None:
+            return None
+        if commit and self.submission:
+            # The commit=False save above leaves the old answers alone.
+            Answer.delete_answers(
+                self.submission.answer_set.filter(question=self.question))
         if obj.value:
-            obj.latitude, obj.longitude = get_latitude_and_longitude(obj.value)
+            # Uncommitted answers get geocoded by
+            # Submission.save_with_answers once they're in the database.
             if commit:
+                pending = obj.geocode()
                 obj.save()
+                if pending:
+                    PendingGeocode.objects.create(answer=obj)
             return obj
         return None
 
 
+def option_value(option):
+    """ The value crowdsourcing saves when someone picks option. """
+    return strip_tags(option).replace('&amp;', '&').replace('"', "'").strip()
+
+
 class BaseOptionAnswer(BaseAnswerForm):
-    def __init__(self, *args, **kwargs):
-        super(BaseOptionAnswer, self).__init__(*args, **kwargs)
+    def _configure_answer_field(self):
+        answer = super(BaseOptionAnswer, self)._configure_answer_field()
         options = self.question.parsed_options
         # appendChoiceButtons in survey.js duplicates this. jQuery and django
         # use " for html attributes, so " will mess them up.
@@ -197,20 +222,18 @@ class BaseOptionAnswer(BaseAnswerForm):
             choices = [('', '---------',)] + choices
         if self.question.allow_arbitrary:
             choices.append(('arbitrary_answer',self.question.arbitrary_label))
-        self.fields['answer'].choices = choices
+        answer.choices = choices
         if self.question.allow_arbitrary:
             choice_control_name = self.add_prefix('answer')
             widget = TextInput(attrs={'arb_boundto':choice_control_name,'arb_choice':'arbitrary_answer','class':'arbitrary_textbox'})
             self.fields['answer_arbitrary'] = CharField(label="", widget=widget, required=False)
-        self.populate_from_submission()
+        return answer
 
     def make_choice(self, str):
         """
         Convert given option string into a key,value tuple suitable for use as option value
         """
-        key = strip_tags(str).replace('&amp;', '&').replace('"', "'").strip()
-        val = mark_safe(str)
-        return key, val
+        return option_value(str), mark_safe(str)
 
     def populate_from_submission(self):
         if self.submission is None:
@@ -244,8 +267,10 @@ class BaseOptionAnswer(BaseAnswerForm):
         # dont wind up recording answers multiple times for the same question
         # in the same submission (which can happen for surveys where it is enabled
         # to resubmit the survey (change your answers)
-        if self.submission:
-            self.submission.get_question_answers(self.question).delete()
+        self.replaces_answers = bool(self.submission)
+        if commit and self.submission:
+            Answer.delete_answers(
+                self.submission.answer_set.filter(question=self.question))
         for text in self.cleaned_data['answer']:
             ans = Answer()
             if self.submission:
@@ -326,23 +351,80 @@ def forms_for_survey(survey, request='testing', submission=None):
         session_key = get_session(request).session_key.lower()
     post = None if testing else request.POST or None
     files = None if testing else request.FILES or None
+    questions = survey.get_fields()
     if submission:
+        submission.prefetch_answers(questions)
         main_form = SubmissionForm(survey, data=post, files=files, instance=submission)
     else:
         main_form = SubmissionForm(survey, data=post, files=files)
-    return [_form_for_question(q, session_key, submission, post, files)
-        for q in survey.questions.all().order_by("order")] + [main_form]
+    form_classes = compiled_forms_for_survey(survey, questions)
+    return [_form_for_question(q, session_key, submission, post, files, cls)
+        for q, cls in zip(questions, form_classes)] + [main_form]
+
+
+# (survey id, schema version) -> form classes, one per question in order.
+_COMPILED_FORMS = {}
+
+
+def compiled_forms_for_survey(survey, questions=None):
+    """ Form classes for the survey's questions with their labels, choices,
+    etc. already set up, so building a form only has to bind data. They're
+    compiled once per process for each version of the survey's schema. """
+    if questions is None:
+        questions = survey.get_fields()
+    if not survey.pk:
+        return [compile_question_form(q) for q in questions]
+    key = (survey.pk, survey.get_schema_version())
+    form_classes = _COMPILED_FORMS.get(key)
+    if form_classes is None:
+        form_classes = [compile_question_form(q) for q in questions]
+        for old_key in [k for k in _COMPILED_FORMS.keys() if k[0] == key[0]]:
+            _COMPILED_FORMS.pop(old_key, None)
+        _COMPILED_FORMS[key] = form_classes
+    return form_classes
+
+
+def compile_question_form(question):
+    """ Subclass the question type's form with fields configured for this
+    question. """
+    base = QTYPE_FORM[question.option_type]
+    configured = base(question=question,
+                      session_key="",
+                      prefix=_question_prefix(question))
+    for field in configured.fields.values():
+        if isinstance(field, ChoiceField):
+            field._choices = field.widget.choices = _SharedChoices(
+                field.choices)
+    form_class = type(base.__name__, (base,), {"compiled": True})
+    form_class.base_fields = configured.fields
+    return form_class
+
+
+class _SharedChoices(list):
+    """ Every form built from a compiled class uses the same choices.
+    Django would otherwise deep copy them for each form. """
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _question_prefix(question):
+    return '%s_%s' % (question.survey_id, question.id)
 
 
 def _form_for_question(question,
                        session_key="",
                        submission=None,
                        data=None,
-                       files=None):
-    return QTYPE_FORM[question.option_type](
+                       files=None,
+                       form_class=None):
+    form_class = form_class or QTYPE_FORM[question.option_type]
+    return form_class(
         question=question,
         session_key=session_key,
         submission=submission,
-        prefix='%s_%s' % (question.survey.id, question.id),
+        prefix=_question_prefix(question),
         data=data,
         files=files)
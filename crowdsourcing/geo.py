@@ -1,6 +1,8 @@
-import cStringIO
+import csv
 import logging
-import sys
+import math
+import re
+import time
 
 try:
     import geopy
@@ -10,24 +12,131 @@ except ImportError:
 
 from django.conf import settings
 
+from .util import get_function
 from . import settings as local_settings
 
+
+def normalize_location(location):
+    """ Locations that only differ by case and spacing geocode the same. """
+    return re.sub(r"\s+", " ", location or "").strip().lower()
+
+
+class Geocoder(object):
+    """ Subclasses implement geocode, which takes a location and returns
+    (latitude, longitude), or (None, None) if the location doesn't exist, and
+    raises if the geocoder fails. """
+    # Seconds to wait between requests in geocode_many.
+    interval = 0
+
+    def geocode(self, location):
+        raise NotImplementedError
+
+    def geocode_many(self, locations):
+        """ location -> (latitude, longitude) for each location, leaving out
+        the ones that failed. """
+        found = {}
+        for i, location in enumerate(locations):
+            if i and self.interval:
+                time.sleep(self.interval)
+            try:
+                found[location] = self.geocode(location)
+            except Exception as ex:
+                logging.exception("error in geocoding: %s" % str(ex))
+        return found
+
+
+class GoogleGeocoder(Geocoder):
+    """ Geocodes with geopy's GoogleV3 geocoder. geocode raises whatever
+    geopy raises if the request fails, and returns (None, None) if Google
+    doesn't know the location. """
+    def __init__(self):
+        if geopy is None:
+            raise ImportError("No module named geopy")
+        self.client = geopy.geocoders.GoogleV3()
+
+    def geocode(self, location):
+        some = list(self.client.geocode(location, exactly_one=False) or [])
+        if some:
+            place, (lat, long) = some[0]
+            return lat, long
+        return None, None
+
+    @property
+    def interval(self):
+        return local_settings.GEOCODE_INTERVAL
+
+
+class GazetteerGeocoder(Geocoder):
+    """ Geocodes from CROWDSOURCING_GAZETTEER_FILE without any network
+    access, for tests and servers that can't reach a geocoding service. Each
+    line of the file is a csv row of location, latitude, and longitude. """
+    def __init__(self, path=None):
+        self.places = {}
+        with open(path or local_settings.GAZETTEER_FILE, "rb") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].startswith("#"):
+                    continue
+                location = ",".join(row[:-2]).decode("utf-8")
+                self.places[normalize_location(location)] = (
+                    float(row[-2]),
+                    float(row[-1]))
+
+    def geocode(self, location):
+        return self.places.get(normalize_location(location), (None, None))
+
+
+# Answers store their quadkey to this many digits, which is plenty for the
+# deepest zoom Google Maps shows.
+QUADKEY_ZOOM = 20
+
+# The Mercator projection stops here.
+_MAX_LATITUDE = 85.05112878
+
+
+def quadkey(latitude, longitude, zoom=QUADKEY_ZOOM):
+    """ The quadkey of the map tile at zoom containing the point, which is
+    the quadkey of every tile containing it at lower zooms with more digits
+    on the end. Returns "" if the point is missing a coordinate. """
+    if latitude is None or longitude is None:
+        return ""
+    latitude = max(-_MAX_LATITUDE, min(_MAX_LATITUDE, latitude))
+    sin_latitude = math.sin(math.radians(latitude))
+    x = (longitude + 180) / 360.0
+    y = 0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    tiles = 2 ** zoom
+    tile_x = max(0, min(tiles - 1, int(x * tiles)))
+    tile_y = max(0, min(tiles - 1, int(y * tiles)))
+    return tile_quadkey(tile_x, tile_y, zoom)
+
+
+def tile_quadkey(x, y, zoom):
+    """ The quadkey of Google Maps tile x, y at zoom. """
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    """ The CROWDSOURCING_GEOCODER, created once per process. """
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = get_function(local_settings.GEOCODER)()
+    return _geocoder
+
+
 def get_latitude_and_longitude(location):
-    if geopy is None:
-        raise ImportError("No module named geopy")
-    g = geopy.geocoders.GoogleV3()
-    oldstdout = sys.stdout
+    """ Ask the geocoder directly. Use
+    crowdsourcing.models.GeocodedLocation.lookup instead to remember the
+    answer. """
     try:
-        sys.stdout = cStringIO.StringIO()
-        try:
-            some = list(g.geocode(location, exactly_one=False))
-            if some:
-                place, (lat, long) = some[0]
-            else:
-                lat = long = None
-        except Exception as ex:
-            logging.exception("error in geocoding: %s" % str(ex))
-            lat = long = None
-    finally:
-        sys.stdout = oldstdout
-    return lat, long
+        return get_geocoder().geocode(location)
+    except ImportError:
+        raise
+    except Exception as ex:
+        logging.exception("error in geocoding: %s" % str(ex))
+        return None, None
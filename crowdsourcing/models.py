@@ -3,10 +3,12 @@ from __future__ import absolute_import
 
 import datetime
 import logging
-from math import sin, cos
+from math import asin, cos, pi, sin
 from operator import itemgetter
 import re
 from textwrap import fill
+import uuid
+import weakref
 from crowdsourcing import settings
 
 try:
@@ -18,8 +20,11 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models, connection
-from django.db.models import Count
+from django.db import models, connection, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.deletion import Collector
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
 from django.db.models.fields.files import ImageFieldFile
 from django.db.models.query import EmptyQuerySet
 from decimal import Decimal
@@ -27,9 +32,11 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe
 
 
+from . import bitmaps
+from .cacheutils import bump_version, get_version, versioned_key
 from .fields import ImageWithThumbnailsField
-from .geo import get_latitude_and_longitude
-from .util import ChoiceEnum, remove_by_lambda
+from .geo import get_geocoder, normalize_location, quadkey
+from .util import ChoiceEnum, atomic, on_commit, remove_by_lambda
 from . import settings as local_settings
 from .settings import *
 
@@ -47,6 +54,11 @@ except ImportError:
     logging.warn('no flickr support available')
     sync_to_flickr = None
 
+try:
+    from .parquetsupport import iter_parquet
+except ImportError:
+    iter_parquet = None
+
 
 ARCHIVE_POLICY_CHOICES = ChoiceEnum(('immediate',
                                      'post-close',
@@ -89,7 +101,9 @@ class LiveSurveyManager(models.Manager):
             models.Q(ends_at__gt=now))
 
 
-FORMAT_CHOICES = ('json', 'csv', 'xml', 'html',)
+FORMAT_CHOICES = ('json', 'ndjson', 'ndjson.gz', 'csv', 'xml', 'html',)
+if iter_parquet:
+    FORMAT_CHOICES += ('parquet',)
 
 
 class Survey(models.Model):
@@ -136,6 +150,18 @@ class Survey(models.Model):
             "Send a notification to these e-mail addresses whenever someone "
             "submits an entry to this survey. Comma delimited. Messages to "
             "staff emails will include admin urls."))
+    email_digest_size = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text=_("Only applies if notification emails are sent in the "
+                    "background. Send one email for every this many "
+                    "submissions instead of one per submission."))
+    email_digest_minutes = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text=_("Only applies if notification emails are sent in the "
+                    "background. Send one email with all the submissions "
+                    "from this many minutes instead of one per submission."))
     site = models.ForeignKey(Site)
     flickr_group_id = models.CharField(
         max_length=60,
@@ -167,7 +193,7 @@ class Survey(models.Model):
         kwargs = {'slug': self.slug}
         submit_url = reverse('embeded_survey_questions', kwargs=kwargs)
         report_url = reverse('survey_default_report_page_1', kwargs=kwargs)
-        questions = self.questions.order_by("order")
+        questions = self.get_fields()
         return dict(title=self.title,
                     id=self.id,
                     slug=self.slug,
@@ -218,13 +244,40 @@ class Survey(models.Model):
         return [f for f in self.get_fields() if f.answer_is_public]
 
     def is_valid_fieldname(self, fieldname):
-        return self.questions.filter(fieldname=fieldname).count() > 0
+        return any(f.fieldname == fieldname for f in self.get_fields())
+
+    def get_schema_version(self):
+        """ Saving the survey or any of its questions bumps this. """
+        return get_version("survey_schema_%d" % self.pk)
+
+    def get_data_version(self):
+        """ New public submissions and moderation bump this. """
+        return get_version("survey_data_%d" % self.pk)
+
+    def _get_schema(self):
+        """ The survey's ordered questions, with their options already
+        parsed, shared across processes through the cache. """
+        if not self.pk:
+            return list(self.questions.order_by("order"))
+        version = self.get_schema_version()
+        key = versioned_key("survey_schema", version, self.pk)
+        questions = cache.get(key)
+        if questions is None:
+            questions = list(self.questions.order_by("order"))
+            for question in questions:
+                question.parsed_options, question.parsed_map_icons
+                # The related manager already attached this survey, and we
+                # don't want it pickled along with the questions.
+                question.__dict__.pop("_survey_cache", None)
+            cache.set(key, questions, local_settings.SCHEMA_CACHE_TIMEOUT)
+        for question in questions:
+            # This doesn't query.
+            question.survey = self
+        return questions
 
     def get_fields(self, fieldnames=None):
         if not "_fields" in self.__dict__:
-            questions = self.questions.all()
-            questions = questions.select_related("survey")
-            self.__dict__["_fields"] = list(questions.order_by("order"))
+            self.__dict__["_fields"] = self._get_schema()
         fields = self.__dict__["_fields"]
         if fieldnames:
             return [f for f in fields if f.fieldname in fieldnames or f.fieldname_longform in fieldnames]
@@ -243,12 +296,9 @@ class Survey(models.Model):
 
     def icon_questions(self):
         OTC = OPTION_TYPE_CHOICES
-        return self.questions.filter(
-            ~models.Q(map_icons=""),
-            option_type__in=[OTC.SELECT,
-                             OTC.CHOICE,
-                             OTC.NUMERIC_SELECT,
-                             OTC.NUMERIC_CHOICE])
+        types = (OTC.SELECT, OTC.CHOICE, OTC.NUMERIC_SELECT, OTC.NUMERIC_CHOICE)
+        return [q for q in self.get_fields()
+                if q.map_icons and q.option_type in types]
 
     def parsed_option_icon_pairs(self):
         icon_questions = self.icon_questions()
@@ -433,15 +483,25 @@ class Question(models.Model):
             self.numeric_is_int = False
         super(Question, self).save(*args, **kwargs)
 
+    def _parsed_lines(self, attr):
+        """ Parse once per value of attr. The result gets pickled along with
+        the question in the survey schema cache. """
+        raw = getattr(self, attr)
+        parsed = self.__dict__.get("_parsed_" + attr)
+        if parsed is None or parsed[0] != raw:
+            lines = filter(None, (s.strip() for s in raw.splitlines()))
+            parsed = self.__dict__["_parsed_" + attr] = (raw, lines)
+        return parsed[1]
+
     @property
     def parsed_options(self):
         if OPTION_TYPE_CHOICES.BOOL == self.option_type:
             return [True, False]
-        return filter(None, (s.strip() for s in self.options.splitlines()))
+        return self._parsed_lines("options")
 
     @property
     def parsed_map_icons(self):
-        return filter(None, (s.strip() for s in self.map_icons.splitlines()))
+        return self._parsed_lines("map_icons")
 
     def parsed_option_icon_pairs(self):
         options = self.parsed_options
@@ -454,6 +514,18 @@ class Question(models.Model):
                 to_return.append((options[i], None))
         return to_return
 
+    @property
+    def icon_by_option(self):
+        """ option -> map icon for the options that have one. Like the parsed
+        options, it's built once per value of options and map_icons. """
+        raw = (self.options, self.map_icons)
+        cached = self.__dict__.get("_icon_by_option")
+        if cached is None or cached[0] != raw:
+            icons = dict((option, icon) for option, icon
+                         in self.parsed_option_icon_pairs() if icon)
+            cached = self.__dict__["_icon_by_option"] = (raw, icons)
+        return cached[1]
+
     @property
     def value_column(self):
         ot = self.option_type
@@ -527,67 +599,139 @@ def extra_from_filters(set, submission_id_column, survey, request_data):
 
 
 def extra_clauses_from_filters(submission_id_column, survey, request_data):
-    return_value = []
+    """ A list with the one clause that limits submission_id_column to the
+    submissions matching the filters, or an empty list if nothing is
+    filtered. The clause lists the ids outright when there are few enough
+    of them. Otherwise it's the subquery from _filter_subquery. """
+    filtered = filtered_submission_ids(survey, request_data)
+    if filtered is None:
+        return []
+    ids, sql, params = filtered
+    if ids is None:
+        return [("%s IN (%s)" % (submission_id_column, sql), params)]
+    if not ids:
+        return [("1 = 0", [])]
+    ids = ",".join(str(id) for id in ids)
+    return [("%s IN (%s)" % (submission_id_column, ids), [])]
+
+
+# id(request_data) -> (weak reference to request_data,
+#                      {survey id: filtered_submission_ids(...)})
+# request_data is usually request.GET, which isn't hashable, so this keys on
+# its id and drops the entry when request_data goes away.
+_FILTERED_IDS = {}
+
+
+def _filtered_ids_memo(request_data):
+    key = id(request_data)
+    entry = _FILTERED_IDS.get(key)
+    if entry is None or entry[0]() is not request_data:
+        def forget(ref):
+            if _FILTERED_IDS.get(key, (None,))[0] is ref:
+                del _FILTERED_IDS[key]
+        try:
+            ref = weakref.ref(request_data, forget)
+        except TypeError:  # request_data doesn't support weak references.
+            return {}
+        entry = _FILTERED_IDS[key] = (ref, {})
+    return entry[1]
+
+
+def filtered_submission_ids(survey, request_data):
+    """ Every chart, map, and list on a report page filters by the same
+    request data. This runs the filters once per request and survey and
+    remembers the result. Returns None if nothing is filtered. Otherwise
+    returns (ids, sql, params) where sql and params select the ids of the
+    matching submissions. ids is the sorted list of those ids, or None if
+    there are more than CROWDSOURCING_FILTER_INLINE_IDS of them. """
+    memo = _filtered_ids_memo(request_data)
+    if survey.id not in memo:
+        subquery = _filter_subquery(survey, request_data)
+        if subquery is None:
+            memo[survey.id] = None
+        else:
+            sql, params = subquery
+            ids = None
+            limit = local_settings.FILTER_INLINE_IDS
+            if limit:
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+                rows = cursor.fetchmany(limit + 1)
+                if len(rows) <= limit:
+                    ids = sorted(row[0] for row in rows)
+            memo[survey.id] = (ids, sql, params)
+    return memo[survey.id]
+
+
+def _filter_subquery(survey, request_data):
+    """ The filters compile into a single query which finds the matching
+    submissions with one pass over the answers. Each answer that satisfies
+    some filter counts toward its submission, and a submission matches if
+    it has answers satisfying every filter. Returns (sql, params), or None
+    if nothing is filtered. """
+    conditions = []
+    params = []
+    question_ids = set()
     for filter in survey.get_filters(request_data):
         loc = filter.location_value and filter.within_value
         if filter.value or filter.from_value or filter.to_value or loc:
             try:
                 OTC = OPTION_TYPE_CHOICES
-                where = "".join((
-                    submission_id_column,
-                    " IN (SELECT submission_id FROM ",
-                    "crowdsourcing_answer WHERE question_id = %d ",
-                    "AND ")) % filter.field.id
                 if OTC.BOOL == filter.field.option_type:
                     f = ("0", "f",)
                     length = len(filter.value)
-                    params = [length and not filter.value[0].lower() in f]
-                    where += "boolean_answer = %s"
+                    filter_params = [
+                        length and not filter.value[0].lower() in f]
+                    where = "boolean_answer = %s"
                 elif filter.field.is_numeric:
                     column = filter.field.value_column
                     convert = float if filter.field.is_float else int
-                    params = []
+                    filter_params = []
                     wheres = []
                     if filter.from_value:
-                        params.append(convert(filter.from_value))
+                        filter_params.append(convert(filter.from_value))
                         wheres.append("%s <= " + column)
                     if filter.to_value:
-                        params.append(convert(filter.to_value))
+                        filter_params.append(convert(filter.to_value))
                         wheres.append(column + " <= %s")
                     if filter.value:
-                        params.append(convert(filter.value))
+                        filter_params.append(convert(filter.value))
                         wheres.append(column + " = %s")
-                    where += " AND ".join(wheres)
+                    where = " AND ".join(wheres)
                 elif OTC.LOCATION == filter.field.option_type:
-                    e = _extra_from_distance(filter, submission_id_column)
+                    e = _extra_from_distance(filter)
                     if e:
-                        d_where, params = e
-                        where += d_where
+                        where, filter_params = e
                     else:
-                        break
+                        continue
                 else:
-                    params = [filter.value]
-                    where += "text_answer = %s"
-                where += ")"
-                return_value.append((where, params,))
+                    filter_params = [filter.value]
+                    where = "text_answer = %s"
             except ValueError:
-                pass
-    return return_value
+                continue
+            conditions.append("(question_id = %d AND %s)" % (
+                filter.field.id,
+                where))
+            params.extend(filter_params)
+            question_ids.add(filter.field.id)
+    if not conditions:
+        return None
+    sql = "SELECT submission_id FROM crowdsourcing_answer WHERE "
+    sql += " OR ".join(conditions)
+    if 1 < len(question_ids):
+        sql += (" GROUP BY submission_id "
+                "HAVING COUNT(DISTINCT question_id) = %d") % len(question_ids)
+    return sql, params
 
 
-def _extra_from_distance(filter, submission_id_column):
+def _extra_from_distance(filter):
     """ This uses the Spherical Law of Cosines for a close enough approximation
     of distances. distance = acos(sin(lat1) * sin(lat2) +
                                   cos(lat1) * cos(lat2) *
                                   cos(lng2 - lng1)) * 3959
-    The "radius" of the earth varies between 3,950 and 3,963 miles. """
-    spaces = re.compile(r'\s')
-    key = spaces.sub("+", "lat_lng_of_" + str(filter.location_value.lower()))
-    lat_lng = cache.get(key, None)
-    if lat_lng is None:
-        lat_lng = get_latitude_and_longitude(filter.location_value)
-        cache.set(key, lat_lng)
-    (lat, lng) = lat_lng
+    The "radius" of the earth varies between 3,950 and 3,963 miles. The
+    clause applies to the location question's answers. """
+    (lat, lng) = GeocodedLocation.lookup(filter.location_value)
     if lat is None or lng is None:
         return
     acos_of_args = (
@@ -606,20 +750,40 @@ def _extra_from_distance(filter, submission_id_column):
     # impossible so just always include it. If acos_of < 1 then we need to
     # check the distance.
     where = "".join((
-        submission_id_column,
-        " IN (SELECT ca.submission_id FROM ",
-        "crowdsourcing_answer AS ca JOIN crowdsourcing_submission AS cs ",
-        "ON ca.submission_id = cs.id ",
-        "WHERE cs.survey_id = %s AND latitude IS NOT NULL ",
-        "AND longitude IS NOT NULL AND ",
+        "latitude IS NOT NULL AND longitude IS NOT NULL AND (",
         acos_of,
         " >= 1 OR (",
         acos_of,
         " < 1 AND 3959.0 * acos(",
         acos_of,
         ") <= %s))"))
-    params = [int(filter.field.survey_id), int(filter.within_value)]
-    return where, params
+    params = [int(filter.within_value)]
+    # The bounding box lets the database use the (question, latitude,
+    # longitude) index so it only has to check the distance of nearby
+    # answers.
+    box_where, box_params = _bounding_box(lat, lng, int(filter.within_value))
+    return box_where + where, box_params + params
+
+
+def _bounding_box(lat, lng, miles):
+    """ A clause that's true for at least every point within miles of
+    (lat, lng), and for little else. The box is a bit bigger than it has
+    to be so that rounding never leaves out a point the exact distance
+    check would include. """
+    angle = miles / 3959.0 * 1.01 + 1e-6
+    if angle >= pi:
+        return "", []
+    lat_range = (lat - angle * _D_TO_R, lat + angle * _D_TO_R)
+    if lat_range[0] <= -90 or 90 <= lat_range[1]:
+        # The circle covers a pole, so it covers every longitude.
+        return "latitude BETWEEN %s AND %s AND ", list(lat_range)
+    lng_delta = asin(sin(angle) / cos(_radians(lat))) * _D_TO_R
+    lng_range = (lng - lng_delta, lng + lng_delta)
+    if lng_range[0] < -180 or 180 < lng_range[1]:
+        # Don't bother splitting boxes across the 180th meridian.
+        return "latitude BETWEEN %s AND %s AND ", list(lat_range)
+    return ("latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s AND ",
+            list(lat_range + lng_range))
 
 
 _D_TO_R = 57.295779
@@ -640,21 +804,41 @@ class AggregateResultCount(object):
                  is_staff=False):
         self.answer_set = question.answer_set.none()
         self.answer_value_lookup = {}
+        value_column = question.value_column
         if is_staff or question.answer_is_public:
-            self.answer_set = question.public_answers
-            if is_staff:
-                self.answer_set = question.answer_set
-            self.answer_set = self.answer_set.values(question.value_column)
-            self.answer_set = self.answer_set.annotate(count=Count("id"))
-            self.answer_set = extra_from_filters(self.answer_set,
-                                                 "submission_id",
-                                                 survey,
-                                                 request_data)
-            if surveyreport and surveyreport.featured:
-                self.answer_set = self.answer_set.filter(
-                    submission__featured=True)
+            featured = bool(surveyreport and surveyreport.featured)
+            counts = AnswerBitmaps.counts_for(question,
+                                              survey,
+                                              request_data,
+                                              is_staff,
+                                              featured)
+            clauses = []
+            if counts is None:
+                clauses = extra_clauses_from_filters("submission_id",
+                                                     survey,
+                                                     request_data)
+            if counts is not None:
+                self.answer_set = counts
+                value_column = "value"
+            elif local_settings.MATERIALIZED_COUNTS and not clauses:
+                self.answer_set = AnswerCount.counts_for(question,
+                                                         is_staff,
+                                                         featured)
+                value_column = "value"
+            else:
+                self.answer_set = question.public_answers
+                if is_staff:
+                    self.answer_set = question.answer_set
+                self.answer_set = self.answer_set.values(value_column)
+                self.answer_set = self.answer_set.annotate(count=Count("id"))
+                for where, params in clauses:
+                    self.answer_set = self.answer_set.extra(where=[where],
+                                                            params=params)
+                if featured:
+                    self.answer_set = self.answer_set.filter(
+                        submission__featured=True)
         for answer in self.answer_set:
-            text = fill(u"%s" % answer[question.value_column], 30)
+            text = fill(u"%s" % answer[value_column], 30)
             if answer["count"]:
                 self.answer_value_lookup[text] = {
                     question.fieldname: text,
@@ -702,19 +886,43 @@ class AggregateResult2Axis(object):
         [new_answer_value(x_value) for x_value in x_axis.parsed_options]
 
         x_value_column = "x_axis." + x_axis.value_column
+        filter_clauses = extra_clauses_from_filters("y_axis.submission_id",
+                                                    x_axis.survey,
+                                                    request_data)
+        # All the y axes from the same survey share the same joins, so we
+        # aggregate them together in one query, pivoting on question_id with
+        # one CASE per y axis.
+        y_axes_by_survey = {}
         for y_axis in y_axes:
-            y_axis_column = y_axis.value_column
-            if "boolean_answer" == y_axis_column:
-                y_axis_column = "CAST(y_axis." + y_axis_column + " AS int)"
-            else:
-                y_axis_column = "y_axis." + y_axis_column
+            y_axes_by_survey.setdefault(y_axis.survey_id, []).append(y_axis)
+
+        found_any = False
+        for survey_y_axes in y_axes_by_survey.values():
+            y_axis_columns = []
+            for y_axis in survey_y_axes:
+                y_axis_column = y_axis.value_column
+                if "boolean_answer" == y_axis_column:
+                    y_axis_column = "CAST(y_axis." + y_axis_column + " AS int)"
+                else:
+                    y_axis_column = "y_axis." + y_axis_column
+                y_axis_columns.append(y_axis_column)
 
             # Are the x and y axis from different surveys?
-            two_surveys = x_axis.survey != y_axis.survey
-
-            # we'll be producing an x value and y value based on some
-            select = ("%s AS x_value" % (x_value_column,),
-                      "%s(%s) AS y_value" % (aggregate_function, y_axis_column))
+            two_surveys = x_axis.survey_id != survey_y_axes[0].survey_id
+
+            # we'll be producing an x value and a y value for each y axis
+            # based on some aggregate function
+            select = ["%s AS x_value" % (x_value_column,)]
+            y_value_is_wanted = []
+            for i, (y_axis, y_axis_column) in enumerate(
+                    zip(survey_y_axes, y_axis_columns)):
+                select.append(
+                    "%s(CASE WHEN y_axis.question_id = %d THEN %s END) "
+                    "AS y_value_%d" % (
+                        aggregate_function, y_axis.id, y_axis_column, i))
+                y_value_is_wanted.append(
+                    "(y_axis.question_id = %d AND %s IS NOT NULL)" % (
+                        y_axis.id, y_axis_column))
             select = ", ".join(select)
 
             # if in 'normal operation' and only a single survey is being used in this report, then join on the
@@ -746,9 +954,8 @@ class AggregateResult2Axis(object):
                     """
                 full_from = "(%s) JOIN (%s) ON y_submission.user_id = x_submission.user_id" % (join_a, join_b)
 
-            where = ["y_axis.question_id = %s" % (y_axis.id,),
+            where = ["(%s)" % " OR ".join(y_value_is_wanted),
                      "x_axis.question_id = %s" % (x_axis.id,),
-                     "%s IS NOT NULL" % (y_axis_column,),
                      "x_submission.is_public = 1"
                      ]
             if two_surveys:
@@ -759,7 +966,7 @@ class AggregateResult2Axis(object):
                 if two_surveys:
                     where.append("y_submission.featured = 1")
             params = []
-            for clause, next_params in extra_clauses_from_filters("y_axis.submission_id", x_axis.survey, request_data):
+            for clause, next_params in filter_clauses:
                 where.append(clause)
                 params += next_params
 
@@ -773,15 +980,18 @@ class AggregateResult2Axis(object):
                 print "Exception in query: " + query
                 raise e
 
-            found_any = False
-            for x_value, y_value in cursor.fetchall():
-                found_any = True
-                if isinstance(y_value, Decimal):
-                    y_value = round(y_value, 2)
+            for row in cursor.fetchall():
+                x_value = row[0]
                 answer_value = answer_value_lookup.get(x_value)
                 if not answer_value:
                     answer_value = new_answer_value(x_value)
-                answer_value[y_axis.fieldname] += y_value
+                for y_axis, y_value in zip(survey_y_axes, row[1:]):
+                    if y_value is None:
+                        continue
+                    found_any = True
+                    if isinstance(y_value, Decimal):
+                        y_value = round(y_value, 2)
+                    answer_value[y_axis.fieldname] += y_value
         if x_axis.is_numeric:
             key = x_axis.fieldname
             self.answer_values.sort(lambda x, y: x[key] - y[key])
@@ -820,7 +1030,90 @@ class Submission(models.Model):
     featured = models.BooleanField(default=False)
 
     def get_question_answers(self, question):
-        return self.answer_set.filter(question=question)
+        by_question = self.__dict__.get("_answers_by_question")
+        if by_question is None:
+            return self.answer_set.filter(question=question)
+        return by_question.get(question.id, [])
+
+    def prefetch_answers(self, questions=()):
+        """ Load all of this submission's answers with one query.
+        get_question_answers then returns lists instead of querysets. Pass the
+        survey's questions to save looking each answer's question up. """
+        questions = dict((q.id, q) for q in questions)
+        by_question = {}
+        for answer in self.answer_set.all():
+            if answer.question_id in questions:
+                answer.question = questions[answer.question_id]
+            by_question.setdefault(answer.question_id, []).append(answer)
+        self.__dict__["_answers_by_question"] = by_question
+
+    def save_with_answers(self, answers, replace_questions=()):
+        """ Save this submission and insert all of its answers with a single
+        bulk INSERT inside one transaction. When editing a submission, pass the
+        questions whose old answers should go in replace_questions; they are
+        deleted in the same transaction. Geocoding and syncing to Flickr talk
+        to outside services, so they wait until the rows are committed. """
+        with atomic():
+            if self.pk and replace_questions:
+                Answer.delete_answers(self.answer_set.filter(question__in=[
+                    q.pk for q in replace_questions]))
+            Submission.save_all_with_answers([(self, answers)])
+        self.__dict__.pop("_answers_by_question", None)
+        # Inside a caller's transaction, the rows aren't committed yet.
+        on_commit(lambda: self.answers_committed(answers))
+
+    @classmethod
+    def save_all_with_answers(cls, submissions_and_answers):
+        """ Save a batch of (submission, answers) pairs with one bulk INSERT
+        for all of the answers. This doesn't geocode or sync to Flickr; call
+        answers_committed on each submission once the transaction commits. """
+        all_answers = []
+        with atomic():
+            for submission, answers in submissions_and_answers:
+                submission.save()
+                for answer in answers:
+                    answer.submission = submission
+                all_answers.extend(answers)
+            Answer.objects.bulk_create(all_answers)
+            if local_settings.MATERIALIZED_COUNTS:
+                AnswerCount.add(all_answers)
+            # bulk_create doesn't send post_save.
+            AnswerBitmaps.answers_added(all_answers)
+
+    def answers_committed(self, answers):
+        OTC = OPTION_TYPE_CHOICES
+        option_types = set(a.question.option_type for a in answers)
+        geocode = OTC.LOCATION in option_types
+        flickr = all([OTC.PHOTO in option_types,
+                      local_settings.SYNCHRONOUS_FLICKR_UPLOAD,
+                      sync_to_flickr,
+                      self.survey.flickr_group_id])
+        if not (geocode or flickr):
+            return
+        # bulk_create doesn't hand back primary keys, so reload the answers
+        # that need more work.
+        types = [t for t, wanted in ((OTC.LOCATION, geocode),
+                                     (OTC.PHOTO, flickr)) if wanted]
+        saved = self.answer_set.filter(
+            question__in=[a.question_id for a in answers
+                          if a.question.option_type in types])
+        located = False
+        for answer in saved.select_related("question__survey"):
+            if OTC.LOCATION == answer.question.option_type:
+                if answer.geocode():
+                    PendingGeocode.objects.create(answer=answer)
+                Answer.set_coordinates(answer.pk,
+                                       answer.latitude,
+                                       answer.longitude)
+                located = located or answer.latitude is not None
+            else:
+                answer._sync_self_to_flickr()
+                Answer.objects.filter(pk=answer.pk).update(
+                    flickr_id=answer.flickr_id,
+                    photo_hash=answer.photo_hash)
+        # Map results depend on coordinates set after the save bumped.
+        if located and self.is_public:
+            _bump_survey_data(self.survey_id)
 
     # for moderation
     is_public = models.BooleanField(
@@ -831,6 +1124,8 @@ class Submission(models.Model):
 
     class Meta:
         ordering = ('-submitted_at',)
+        # For paging through a survey's submissions in views.SUBMISSION_ORDER.
+        index_together = (('survey', 'submitted_at', 'id'),)
 
     def to_jsondata(self, answer_lookup=None, include_private_questions=False):
         def to_json(v):
@@ -882,6 +1177,167 @@ class Submission(models.Model):
         return u"%s Submission" % self.survey.title
 
 
+class QueuedItem(models.Model):
+    """ A row in a work queue. Workers claim rows before working on them so
+    that no two work on the same row. """
+    claimed_by = models.CharField(max_length=32, blank=True, editable=False)
+    claimed_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    # A claim this many seconds old belongs to a worker that died, so the
+    # rows go back in the queue.
+    CLAIM_TIMEOUT = 10 * 60
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def claim(cls, limit, queryset=None):
+        """ Claim up to limit unclaimed rows of queryset and return them. The
+        UPDATE skips rows another worker claimed first, so only the rows it
+        actually marked come back. """
+        if queryset is None:
+            queryset = cls.objects.all()
+        now = datetime.datetime.now()
+        stale = now - datetime.timedelta(seconds=cls.CLAIM_TIMEOUT)
+        free = models.Q(claimed_by="") | models.Q(claimed_at__lt=stale)
+        ids = list(queryset.filter(free).values_list("pk", flat=True)[:limit])
+        if not ids:
+            return []
+        token = uuid.uuid4().hex
+        cls.objects.filter(free, pk__in=ids).update(claimed_by=token,
+                                                    claimed_at=now)
+        return list(queryset.filter(claimed_by=token))
+
+
+class PendingSubmission(QueuedItem):
+    """ A validated submission that hasn't been written yet. With
+    CROWDSOURCING_ASYNC_SUBMISSIONS the survey views queue submissions here
+    and crowdsourcing.views.ingest_pending_submissions writes them in bulk.
+    """
+    survey = models.ForeignKey(Survey)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
+    ip_address = models.IPAddressField()
+    submitted_at = models.DateTimeField(default=datetime.datetime.now)
+    session_key = models.CharField(max_length=40, blank=True)
+    is_public = models.BooleanField(default=True)
+    # The host the user submitted on, for the links in notification emails.
+    host = models.CharField(max_length=255, blank=True)
+    # json list of [question id, value] pairs.
+    answer_data = models.TextField(blank=True)
+    # Set when ingest_pending_submissions couldn't write the submission. It
+    # stays in the table with the error for someone to look at, but it's
+    # never claimed again.
+    failed_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    @classmethod
+    def from_submission(cls, submission, answers, host):
+        pending = cls(survey=submission.survey,
+                      user=submission.user,
+                      ip_address=submission.ip_address,
+                      submitted_at=submission.submitted_at,
+                      session_key=submission.session_key,
+                      is_public=submission.is_public,
+                      host=host)
+        pending.answer_data = json.dumps(
+            [(a.question_id, a.value) for a in answers])
+        return pending
+
+    def to_submission(self):
+        """ Return an unsaved Submission and its unsaved answers. """
+        submission = Submission(survey=self.survey,
+                                user_id=self.user_id,
+                                ip_address=self.ip_address,
+                                submitted_at=self.submitted_at,
+                                session_key=self.session_key,
+                                is_public=self.is_public)
+        questions = dict((q.id, q) for q in self.survey.get_fields())
+        answers = []
+        for question_id, value in json.loads(self.answer_data or "[]"):
+            # Skip answers to questions deleted since the user submitted.
+            if question_id in questions:
+                answer = Answer(question=questions[question_id])
+                answer.value = value
+                answers.append(answer)
+        return submission, answers
+
+    def __unicode__(self):
+        return u"Pending %s Submission" % self.survey.title
+
+
+class PendingSurveyEmail(QueuedItem):
+    """ A notification email waiting for
+    crowdsourcing.views.send_pending_survey_emails when
+    CROWDSOURCING_SYNCHRONOUS_SURVEY_EMAIL is off. """
+    survey = models.ForeignKey(Survey)
+    submission = models.ForeignKey(Submission)
+    # The host the user submitted on, for the links in the email.
+    host = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        ordering = ('id',)
+
+
+class GeocodedLocation(models.Model):
+    """ Everything the geocoder has told us, so that no location gets
+    geocoded twice. latitude and longitude are null for locations the
+    geocoder couldn't find. """
+    location = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
+    geocoded_at = models.DateTimeField(default=datetime.datetime.now)
+
+    @classmethod
+    def lookup(cls, location):
+        """ (latitude, longitude) of location, or (None, None) if it can't be
+        found. """
+        return cls.lookup_many([location]).get(location, (None, None))
+
+    @classmethod
+    def lookup_many(cls, locations, geocode=True):
+        """ location -> (latitude, longitude) for each of locations. Asks
+        CROWDSOURCING_GEOCODER about the ones nobody has looked up yet in one
+        batch, unless geocode is false. Locations the geocoder fails on, or
+        doesn't get asked about, are left out. """
+        normalized = {}
+        for location in locations:
+            key = normalize_location(location)
+            if key:
+                normalized.setdefault(key, []).append(location)
+        known = {}
+        # Too long to remember, but we can still geocode them.
+        keys = [k for k in normalized if len(k) <= 255]
+        for i in range(0, len(keys), 500):
+            rows = cls.objects.filter(location__in=keys[i:i + 500])
+            for row in rows.values_list("location", "latitude", "longitude"):
+                known[row[0]] = row[1:]
+        missing = [k for k in normalized if k not in known]
+        if missing and geocode:
+            for key, lat_lng in get_geocoder().geocode_many(missing).items():
+                known[key] = lat_lng
+                if len(key) <= 255:
+                    try:
+                        with atomic():
+                            cls.objects.create(location=key,
+                                               latitude=lat_lng[0],
+                                               longitude=lat_lng[1])
+                    except IntegrityError:
+                        pass  # Somebody else just looked it up.
+        found = {}
+        for key, originals in normalized.items():
+            if key in known:
+                for location in originals:
+                    found[location] = tuple(known[key])
+        return found
+
+    def __unicode__(self):
+        return self.location
+
+
 class Answer(models.Model):
     submission = models.ForeignKey(Submission)
     question = models.ForeignKey(Question)
@@ -898,6 +1354,8 @@ class Answer(models.Model):
         upload_to=local_settings.IMAGE_UPLOAD_PATTERN)
     latitude = models.FloatField(blank=True, null=True)
     longitude = models.FloatField(blank=True, null=True)
+    # geo.quadkey(latitude, longitude), for map tiles.
+    quadkey = models.CharField(max_length=20, blank=True, editable=False)
 
     flickr_id = models.CharField(max_length=64, blank=True)
     photo_hash = models.CharField(max_length=40,
@@ -935,17 +1393,77 @@ class Answer(models.Model):
 
     class Meta:
         ordering = ('question',)
+        # For the bounding box of distance filters.
+        index_together = (('question', 'latitude', 'longitude'),
+                          ('question', 'quadkey'))
 
     def save(self, **kwargs):
         # or should this be in a signal?  Or build in an option
         # to manage asynchronously? @TBD
         if local_settings.SYNCHRONOUS_FLICKR_UPLOAD:
             self._sync_self_to_flickr()
+        self.quadkey = quadkey(self.latitude, self.longitude)
         super(Answer, self).save(**kwargs)
 
+    @classmethod
+    def set_coordinates(cls, pk, latitude, longitude):
+        """ Update one answer's coordinates without saving the rest of it. """
+        cls.objects.filter(pk=pk).update(latitude=latitude,
+                                         longitude=longitude,
+                                         quadkey=quadkey(latitude, longitude))
+
+    @classmethod
+    def delete_answers(cls, answers):
+        """ Delete a queryset of answers. With materialized counts on, this
+        uncounts them in one pass instead of one answer at a time in
+        pre_delete. """
+        if not local_settings.MATERIALIZED_COUNTS:
+            answers.delete()
+            return
+        with atomic():
+            rows = list(answers.select_related("question", "submission"))
+            AnswerCount.add(rows, -1)
+            for answer in rows:
+                answer.__dict__["_uncounted"] = True
+            collector = Collector(using=answers.db)
+            collector.collect(rows)
+            collector.delete()
+
+    @classmethod
+    def fill_quadkeys(cls, batch_size=1000):
+        """ Fill in quadkeys for answers that got their coordinates before
+        Answer had a quadkey. Returns how many it filled. """
+        filled = 0
+        while True:
+            answers = cls.objects.filter(quadkey="",
+                                         latitude__isnull=False,
+                                         longitude__isnull=False)
+            answers = answers.values_list("id", "latitude", "longitude")
+            answers = list(answers.order_by("id")[:batch_size])
+            for pk, latitude, longitude in answers:
+                cls.set_coordinates(pk, latitude, longitude)
+            filled += len(answers)
+            if len(answers) < batch_size:
+                return filled
+
     def __unicode__(self):
         return unicode(self.question)
 
+    def geocode(self):
+        """ Does not save. You must save after geocoding. If
+        CROWDSOURCING_SYNCHRONOUS_GEOCODING is off, this only uses locations
+        that have already been geocoded. Returns True if the answer needs a
+        PendingGeocode, because geocoding was put off or the geocoder
+        failed. """
+        if self.text_answer:
+            synchronous = local_settings.SYNCHRONOUS_GEOCODING
+            found = GeocodedLocation.lookup_many([self.text_answer],
+                                                 geocode=synchronous)
+            location = found.get(self.text_answer, (None, None))
+            self.latitude, self.longitude = location
+            return self.text_answer not in found
+        return False
+
     def _sync_self_to_flickr(self):
         """ Does not save. You must save after syncing. """
         if sync_to_flickr:
@@ -970,6 +1488,351 @@ class Answer(models.Model):
                 answer.save()
 
 
+class PendingGeocode(QueuedItem):
+    """ A location answer waiting for PendingGeocode.geocode_pending, either
+    because CROWDSOURCING_SYNCHRONOUS_GEOCODING is off or because the
+    geocoder failed on it. This is the only place answers get geocoded
+    after they're saved. """
+    answer = models.ForeignKey(Answer)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=datetime.datetime.now,
+                                           db_index=True)
+
+    class Meta:
+        ordering = ('next_attempt_at',)
+
+    @classmethod
+    def queue_missing(cls):
+        """ Queue every location answer that has no coordinates and isn't
+        queued already, like answers saved before geocoding was queued.
+        Returns how many it queued. """
+        answers = Answer.objects.filter(
+            question__option_type=OPTION_TYPE_CHOICES.LOCATION,
+            latitude__isnull=True,
+            pendinggeocode__isnull=True).exclude(text_answer="")
+        ids = list(answers.values_list("pk", flat=True))
+        for i in range(0, len(ids), 500):
+            cls.objects.bulk_create(
+                [cls(answer_id=pk) for pk in ids[i:i + 500]])
+        return len(ids)
+
+    @classmethod
+    def geocode_pending(cls):
+        """ Geocode the next CROWDSOURCING_GEOCODE_BATCH_SIZE answers that
+        are due. Answers the geocoder fails on wait twice as long each time
+        before the next try, and get left without coordinates after
+        CROWDSOURCING_GEOCODE_MAX_ATTEMPTS. Returns how many answers it
+        tried. Workers claim the answers they geocode, so no two send the
+        same one to the geocoder. """
+        now = datetime.datetime.now()
+        due = cls.objects.filter(next_attempt_at__lte=now)
+        due = cls.claim(local_settings.GEOCODE_BATCH_SIZE,
+                        due.select_related("answer__question"))
+        found = GeocodedLocation.lookup_many(
+            p.answer.text_answer for p in due)
+        done = []
+        survey_ids = set()
+        for p in due:
+            answer = p.answer
+            if answer.text_answer in found:
+                lat, lng = found[answer.text_answer]
+                Answer.set_coordinates(answer.pk, lat, lng)
+                done.append(p.pk)
+                survey_ids.add(answer.question.survey_id)
+            elif p.attempts + 1 >= local_settings.GEOCODE_MAX_ATTEMPTS:
+                logging.warn("giving up on geocoding %s" %
+                             answer.text_answer)
+                done.append(p.pk)
+            else:
+                p.attempts += 1
+                delay = local_settings.GEOCODE_RETRY_SECONDS
+                delay *= 2 ** (p.attempts - 1)
+                p.next_attempt_at = now + datetime.timedelta(seconds=delay)
+                p.claimed_by = ""
+                p.claimed_at = None
+                p.save()
+        cls.objects.filter(pk__in=done).delete()
+        for survey_id in survey_ids:
+            _bump_survey_data(survey_id)
+        return len(due)
+
+
+class AnswerCount(models.Model):
+    """ How many answers a question has with each value. It's kept up to
+    date as answers come and go so that unfiltered pie charts don't have to
+    count the answer table. See CROWDSOURCING_MATERIALIZED_COUNTS. """
+    question = models.ForeignKey(Question)
+    value = models.TextField(blank=True)
+    is_public = models.BooleanField(default=False)
+    featured = models.BooleanField(default=False)
+    count = models.IntegerField(default=0)
+
+    @staticmethod
+    def key_for(value):
+        return u"%s" % value
+
+    @classmethod
+    def add(cls, answers, delta=1, is_public=None, featured=None):
+        """ Count the answers, or uncount them if delta is negative. Flags
+        you don't pass come from each answer's submission. """
+        deltas = {}
+        for answer in answers:
+            submission = answer.submission
+            key = (answer.question_id,
+                   cls.key_for(answer.value),
+                   submission.is_public if is_public is None else is_public,
+                   submission.featured if featured is None else featured)
+            deltas[key] = deltas.get(key, 0) + delta
+        for (question_id, value, public, feat), n in deltas.items():
+            counts = cls.objects.filter(question=question_id,
+                                        value=value,
+                                        is_public=public,
+                                        featured=feat)
+            # Two rows for the same value would only mean counts_for sums
+            # them, so we don't bother locking.
+            if not counts.update(count=F("count") + n) and n > 0:
+                cls.objects.create(question_id=question_id,
+                                   value=value,
+                                   is_public=public,
+                                   featured=feat,
+                                   count=n)
+
+    @classmethod
+    def rebuild(cls, questions=None):
+        """ Recount from scratch, by default for every question. """
+        if questions is None:
+            questions = Question.objects.all()
+        for question in questions:
+            column = question.value_column
+            rows = question.answer_set.values(column,
+                                              "submission__is_public",
+                                              "submission__featured")
+            rows = rows.annotate(count=Count("id")).order_by()
+            with atomic():
+                cls.objects.filter(question=question).delete()
+                cls.objects.bulk_create([cls(
+                    question=question,
+                    value=cls.key_for(row[column]),
+                    is_public=row["submission__is_public"],
+                    featured=row["submission__featured"],
+                    count=row["count"]) for row in rows])
+
+    @classmethod
+    def counts_for(cls, question, is_staff=False, featured=False):
+        """ Values and counts, like
+        answer_set.values(question.value_column).annotate(count=Count("id"))
+        only with the values in the "value" key. """
+        counts = cls.objects.filter(question=question)
+        if not is_staff:
+            counts = counts.filter(is_public=True)
+        if featured:
+            counts = counts.filter(featured=True)
+        return counts.values("value").annotate(count=Sum("count")).order_by()
+
+
+class AnswerBitmaps(object):
+    """ Bitmaps of the submissions that gave each answer to a question, and of
+    each survey's public and featured submissions, kept in Django's cache so
+    that filtered counts are bitmap intersections instead of queries. See
+    CROWDSOURCING_BITMAP_INDEX_TIMEOUT. New answers and submissions are
+    added to the bitmaps once they commit. Changing or deleting one starts
+    the bitmaps over. Ids don't commit in order, so reading only the rows past
+    the last id seen would miss some. Instead each commit caches the ids it
+    added as a numbered batch, and loading the bitmaps folds in the batches
+    they haven't seen. """
+    OPTION_TYPES = (OPTION_TYPE_CHOICES.BOOL,
+                    OPTION_TYPE_CHOICES.BOOL_LIST,
+                    OPTION_TYPE_CHOICES.CHOICE,
+                    OPTION_TYPE_CHOICES.SELECT,
+                    OPTION_TYPE_CHOICES.NUMERIC_CHOICE,
+                    OPTION_TYPE_CHOICES.NUMERIC_SELECT)
+
+    @staticmethod
+    def _load(name, version, rows):
+        """ rows() returns (submission id, keys) for every row. """
+        key = versioned_key("bitmaps", version, name)
+        added_key = versioned_key("bitmaps_added", version, name)
+        timeout = local_settings.BITMAP_INDEX_TIMEOUT
+        data = cache.get(key)
+        added = cache.get(added_key)
+        if data is not None and added is not None and added >= data[0]:
+            seen, data = data
+            found = dict((k, bitmaps.loads(v)) for k, v in data.items())
+            batch_keys = [versioned_key("bitmaps_added", version, name, n)
+                          for n in range(seen + 1, added + 1)]
+            batches = cache.get_many(batch_keys) if batch_keys else {}
+            # A missing batch was evicted or hasn't been written yet, so
+            # start over.
+            if len(batches) == len(batch_keys):
+                if not batches:
+                    return found
+                for batch in batches.values():
+                    for k, ids in batch.items():
+                        found[k] = found.get(k, 0) | bitmaps.from_ids(ids)
+                data = dict((k, bitmaps.dumps(v)) for k, v in found.items())
+                cache.set(key, (added, data), timeout)
+                return found
+        # Every batch counted so far committed before rows() reads, so the
+        # rows already have them.
+        cache.add(added_key, 0, timeout)
+        seen = cache.get(added_key, 0)
+        ids = {}
+        for submission_id, keys in rows():
+            for k in keys:
+                ids.setdefault(k, []).append(submission_id)
+        found = dict((k, bitmaps.from_ids(v)) for k, v in ids.items())
+        data = dict((k, bitmaps.dumps(v)) for k, v in found.items())
+        cache.set(key, (seen, data), timeout)
+        return found
+
+    @staticmethod
+    def _add(name, version, ids):
+        """ Cache ids, a dict of key -> submission ids that just committed,
+        as the next batch for _load. """
+        try:
+            n = cache.incr(versioned_key("bitmaps_added", version, name))
+        except ValueError:
+            # Nobody has loaded these bitmaps, or the cache forgot the
+            # counter and the next _load starts over anyway.
+            return
+        cache.set(versioned_key("bitmaps_added", version, name, n),
+                  ids,
+                  local_settings.BITMAP_INDEX_TIMEOUT)
+
+    @staticmethod
+    def _question_version(question_id, survey_id):
+        return (get_version("bitmaps_question_%d" % question_id),
+                get_version("survey_schema_%d" % survey_id))
+
+    @classmethod
+    def for_question(cls, question):
+        """ AnswerCount.key_for(value) -> bitmap of the submissions that
+        answered question with value. """
+        column = question.value_column
+
+        def rows():
+            answers = question.answer_set.values_list("submission_id", column)
+            for submission_id, value in answers.order_by():
+                yield submission_id, [AnswerCount.key_for(value)]
+        version = cls._question_version(question.id, question.survey_id)
+        return cls._load("question_%d" % question.id, version, rows)
+
+    @classmethod
+    def answers_added(cls, answers):
+        """ Add new answers to their questions' bitmaps once they commit. """
+        if not local_settings.BITMAP_INDEX_TIMEOUT:
+            return
+        added = {}
+        for answer in answers:
+            question = answer.question
+            if question.option_type in cls.OPTION_TYPES:
+                ids = added.setdefault((question.id, question.survey_id), {})
+                ids.setdefault(AnswerCount.key_for(answer.value), []).append(
+                    answer.submission_id)
+
+        def add():
+            for (question_id, survey_id), ids in added.items():
+                cls._add("question_%d" % question_id,
+                         cls._question_version(question_id, survey_id),
+                         ids)
+        if added:
+            on_commit(add)
+
+    @staticmethod
+    def _survey_keys(is_public, featured):
+        keys = ["all"]
+        if is_public:
+            keys.append("public")
+        if featured:
+            keys.append("featured")
+        return keys
+
+    @classmethod
+    def for_survey(cls, survey_id):
+        """ The survey's submissions as the bitmaps "all", "public", and
+        "featured". """
+        def rows():
+            submissions = Submission.objects.filter(survey=survey_id)
+            submissions = submissions.values_list("id",
+                                                  "is_public",
+                                                  "featured")
+            for id, is_public, featured in submissions.order_by():
+                yield id, cls._survey_keys(is_public, featured)
+        version = get_version("bitmaps_survey_%d" % survey_id)
+        found = cls._load("survey_%d" % survey_id, version, rows)
+        for k in ("all", "public", "featured"):
+            found.setdefault(k, 0)
+        return found
+
+    @classmethod
+    def submission_added(cls, submission):
+        """ Add a new submission to its survey's bitmaps once it commits. """
+        if not local_settings.BITMAP_INDEX_TIMEOUT:
+            return
+        survey_id = submission.survey_id
+        keys = cls._survey_keys(submission.is_public, submission.featured)
+        ids = dict((k, [submission.id]) for k in keys)
+        on_commit(lambda: cls._add("survey_%d" % survey_id,
+                                   get_version("bitmaps_survey_%d" % survey_id),
+                                   ids))
+
+    @classmethod
+    def _filter_key(cls, filter):
+        """ The bitmap for filter has this key. Raises ValueError like
+        _filter_subquery does for values that don't convert. """
+        field = filter.field
+        if OPTION_TYPE_CHOICES.BOOL == field.option_type:
+            value = not filter.value[0].lower() in ("0", "f")
+        elif field.is_numeric:
+            value = (float if field.is_float else int)(filter.value)
+        else:
+            value = filter.value
+        return AnswerCount.key_for(value)
+
+    @classmethod
+    def counts_for(cls, question, survey, request_data, is_staff=False,
+                   featured=False):
+        """ Counts like AnswerCount.counts_for, only filtered by
+        request_data. Returns None if the bitmaps can't do it, which is when
+        they're off, nothing is filtered, or a filter or question isn't a
+        choice. """
+        if not local_settings.BITMAP_INDEX_TIMEOUT:
+            return None
+        if question.option_type not in cls.OPTION_TYPES:
+            return None
+        loaded = {}
+
+        def for_question(question):
+            if question.id not in loaded:
+                loaded[question.id] = cls.for_question(question)
+            return loaded[question.id]
+        selected = None
+        for filter in survey.get_filters(request_data):
+            if filter.from_value or filter.to_value or filter.within_value:
+                return None
+            if not filter.value:
+                continue
+            if filter.field.option_type not in cls.OPTION_TYPES:
+                return None
+            try:
+                key = cls._filter_key(filter)
+            except ValueError:
+                continue
+            bitmap = for_question(filter.field).get(key, 0)
+            selected = bitmap if selected is None else selected & bitmap
+        if selected is None:
+            return None
+        submissions = cls.for_survey(question.survey_id)
+        selected &= submissions["all" if is_staff else "public"]
+        if featured:
+            selected &= submissions["featured"]
+        counts = []
+        for value, bitmap in for_question(question).items():
+            counts.append(dict(value=value,
+                               count=bitmaps.popcount(bitmap & selected)))
+        return counts
+
+
 class SurveyReport(models.Model):
     """
     a survey report permits the presentation of data submitted in a
@@ -1022,7 +1885,7 @@ class SurveyReport(models.Model):
 
         return None if given fieldname is not among our surveys (or if it is ambiguous)
         """
-        all_my_questions = Question.objects.filter(survey__surveyreport__id__exact=self.id)
+        surveys = self.survey.all()
 
         # if fieldname has a period in it, then the first half is a survey slug and
         # second half is question fieldname
@@ -1030,11 +1893,11 @@ class SurveyReport(models.Model):
         # report's selected surveys
         if fieldname.count(".") == 1:
             s_slug, fieldname = fieldname.split(".")
-            matching_questions = all_my_questions.filter(survey__slug=s_slug).filter(fieldname=fieldname)
-        else:
-            matching_questions = all_my_questions.filter(fieldname=fieldname)
+            surveys = [s for s in surveys if s.slug == s_slug]
+        matching_questions = [q for s in surveys for q in s.get_fields()
+                              if q.fieldname == fieldname]
 
-        if len(list(matching_questions)) == 1:
+        if len(matching_questions) == 1:
             return matching_questions[0]
         else:
             return None
@@ -1215,3 +2078,124 @@ def get_all_answers(submission_list, include_private_questions=False):
             page_answers[answer.submission_id] = []
         page_answers[answer.submission_id].append(answer)
     return page_answers
+
+
+def _bump_survey_schema(sender, instance, **kwargs):
+    # Like the data version, this waits for the commit so that nobody caches
+    # the old questions under the new version.
+    survey_id = instance.pk if sender is Survey else instance.survey_id
+    on_commit(lambda: bump_version("survey_schema_%d" % survey_id))
+
+
+for model in (Survey, Question):
+    post_save.connect(_bump_survey_schema, sender=model)
+    post_delete.connect(_bump_survey_schema, sender=model)
+
+
+def _bump_cors_sites(sender, **kwargs):
+    on_commit(lambda: bump_version("cors_sites"))
+
+
+post_save.connect(_bump_cors_sites, sender=Site)
+post_delete.connect(_bump_cors_sites, sender=Site)
+
+
+def _uncount_old_answer(sender, instance, raw=False, **kwargs):
+    if local_settings.MATERIALIZED_COUNTS and instance.pk and not raw:
+        AnswerCount.add(Answer.objects.filter(pk=instance.pk), -1)
+
+
+def _count_answer(sender, instance, raw=False, **kwargs):
+    if local_settings.MATERIALIZED_COUNTS and not raw:
+        AnswerCount.add([instance])
+
+
+def _uncount_answer(sender, instance, **kwargs):
+    # Answer.delete_answers has already uncounted its answers.
+    uncounted = instance.__dict__.pop("_uncounted", False)
+    if local_settings.MATERIALIZED_COUNTS and not uncounted:
+        AnswerCount.add([instance], -1)
+
+
+def _answer_bitmaps(sender, instance, raw=False, created=False, **kwargs):
+    if raw:
+        return
+    if created:
+        AnswerBitmaps.answers_added([instance])
+    else:
+        _forget_question_bitmaps(instance.question_id)
+
+
+def _forget_question_bitmaps(question_id):
+    if local_settings.BITMAP_INDEX_TIMEOUT:
+        on_commit(lambda: bump_version("bitmaps_question_%d" % question_id))
+
+
+def _forget_survey_bitmaps(survey_id):
+    if local_settings.BITMAP_INDEX_TIMEOUT:
+        on_commit(lambda: bump_version("bitmaps_survey_%d" % survey_id))
+
+
+def _bump_survey_data(survey_id):
+    """ Bump once the change commits. Bumping any sooner lets a report
+    rendered from the old data get cached under the new version. """
+    if local_settings.REPORT_CACHE_TIMEOUT or local_settings.HTTP_CACHE_TIMEOUT:
+        on_commit(lambda: bump_version("survey_data_%d" % survey_id))
+
+
+def _submission_changing(sender, instance, raw=False, **kwargs):
+    counts = local_settings.MATERIALIZED_COUNTS
+    if raw or not any([counts,
+                       local_settings.REPORT_CACHE_TIMEOUT,
+                       local_settings.HTTP_CACHE_TIMEOUT,
+                       local_settings.BITMAP_INDEX_TIMEOUT]):
+        return
+    new = (instance.is_public, instance.featured)
+    old = None
+    if instance.pk:
+        rows = Submission.objects.filter(pk=instance.pk)
+        rows = list(rows.values_list("is_public", "featured"))
+        old = rows[0] if rows else None
+    moderated = old is not None and old != new
+    # The row isn't written yet, so _submission_changed bumps.
+    instance.__dict__["_bump_survey_data"] = instance.is_public or moderated
+    if counts and moderated:
+        answers = list(instance.answer_set.select_related("question"))
+        AnswerCount.add(answers, -1, *old)
+        AnswerCount.add(answers, 1, *new)
+
+
+def _submission_changed(sender, instance, raw=False, created=False,
+                        **kwargs):
+    if instance.__dict__.pop("_bump_survey_data", False):
+        _bump_survey_data(instance.survey_id)
+    if raw:
+        return
+    if created:
+        AnswerBitmaps.submission_added(instance)
+    else:
+        _forget_survey_bitmaps(instance.survey_id)
+
+
+def _submission_deleted(sender, instance, **kwargs):
+    if instance.is_public:
+        _bump_survey_data(instance.survey_id)
+    _forget_survey_bitmaps(instance.survey_id)
+
+
+def _bump_survey_report(sender, instance, **kwargs):
+    report_id = instance.pk if sender is SurveyReport else instance.report_id
+    on_commit(lambda: bump_version("survey_report_%d" % report_id))
+
+
+pre_save.connect(_uncount_old_answer, sender=Answer)
+post_save.connect(_count_answer, sender=Answer)
+pre_delete.connect(_uncount_answer, sender=Answer)
+post_save.connect(_answer_bitmaps, sender=Answer)
+post_delete.connect(_answer_bitmaps, sender=Answer)
+pre_save.connect(_submission_changing, sender=Submission)
+post_save.connect(_submission_changed, sender=Submission)
+post_delete.connect(_submission_deleted, sender=Submission)
+for model in (SurveyReport, SurveyReportDisplay):
+    post_save.connect(_bump_survey_report, sender=model)
+    post_delete.connect(_bump_survey_report, sender=model)
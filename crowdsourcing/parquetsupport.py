@@ -0,0 +1,77 @@
+"""
+support for exporting submissions as Parquet files.
+"""
+from __future__ import absolute_import
+
+import pyarrow
+import pyarrow.parquet
+
+
+# Export column kinds -> (arrow type, conversion from the to_jsondata value)
+_KINDS = {
+    "text": (pyarrow.string(), lambda v: u"%s" % v),
+    "integer": (pyarrow.int64(), int),
+    "float": (pyarrow.float64(), float),
+    "boolean": (pyarrow.bool_(), bool),
+    "datetime": (pyarrow.timestamp("s"), lambda v: v),
+}
+
+
+class _Sink(object):
+    """ ParquetWriter writes here, and iter_parquet hands back whatever it
+    wrote after each row group. """
+    def __init__(self):
+        self.closed = False
+        self._position = 0
+        self._written = []
+
+    def write(self, data):
+        data = bytes(data)
+        self._written.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._written)
+        self._written = []
+        return data
+
+
+def iter_parquet(rows, columns, chunk_size):
+    """ Yield a Parquet file of rows, which are flattened to_jsondata dicts,
+    one row group of chunk_size rows at a time. columns is a list of
+    (key, kind) pairs where kind is a key of _KINDS. """
+    schema = pyarrow.schema([pyarrow.field(key, _KINDS[kind][0])
+                             for key, kind in columns])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+
+    def row_group(chunk):
+        arrays = []
+        for key, kind in columns:
+            arrow_type, convert = _KINDS[kind]
+            values = [row.get(key) for row in chunk]
+            values = [None if v is None else convert(v) for v in values]
+            arrays.append(pyarrow.array(values, type=arrow_type))
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        return sink.drain()
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield row_group(chunk)
+            chunk = []
+    if chunk:
+        yield row_group(chunk)
+    writer.close()
+    yield sink.drain()
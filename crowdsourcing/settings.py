@@ -147,3 +147,139 @@ ALL_STAFF_EMAIL_NOTIFICATION = getattr(
     _gs,
     'CROWDSOURCING_ALL_STAFF_EMAIL_NOTIFICATION',
     True)
+
+
+# Sending notification emails synchronously means the user waits on your SMTP
+# server every time they enter a survey that has notification emails. Set this
+# to False to queue the emails instead, and set up a regular call to
+# crowdsourcing.views.send_pending_survey_emails, which sends everything
+# queued over one connection. crowdsourcing/tasks.py attempts to set up a
+# celery task. Surveys can then also ask for digests, see
+# Survey.email_digest_size and Survey.email_digest_minutes.
+SYNCHRONOUS_SURVEY_EMAIL = getattr(
+    _gs,
+    'CROWDSOURCING_SYNCHRONOUS_SURVEY_EMAIL',
+    True)
+
+
+# Write submissions asynchronously. The survey views still validate the forms
+# right away, but then they just queue the answers in the
+# crowdsourcing_pendingsubmission table and return. Set up a regular call to
+# crowdsourcing.views.ingest_pending_submissions to write them in bulk;
+# crowdsourcing/tasks.py attempts to set up a celery task. Surveys with photo
+# questions and surveys that let users change their answers are always written
+# synchronously.
+ASYNC_SUBMISSIONS = getattr(_gs, 'CROWDSOURCING_ASYNC_SUBMISSIONS', False)
+
+
+# How many queued submissions ingest_pending_submissions writes per call.
+INGEST_BATCH_SIZE = getattr(_gs, 'CROWDSOURCING_INGEST_BATCH_SIZE', 500)
+
+
+# Crowdsourcing caches each survey's questions in Django's cache so survey
+# pages don't have to read them on every request. Saving a survey or a
+# question invalidates its cache right away, so this timeout only matters for
+# freeing up space.
+SCHEMA_CACHE_TIMEOUT = getattr(_gs,
+                               'CROWDSOURCING_SCHEMA_CACHE_TIMEOUT',
+                               24 * 60 * 60)
+
+
+# Keep per-question answer counts in the crowdsourcing_answercount table so
+# that pie charts without filters don't have to count the answer table on
+# every page view. The counts are only maintained while this is on, so run
+# crowdsourcing.models.AnswerCount.rebuild() when you turn it on.
+MATERIALIZED_COUNTS = getattr(_gs, 'CROWDSOURCING_MATERIALIZED_COUNTS', False)
+
+
+# Cache rendered report pages for this many seconds. New public submissions,
+# moderation, and changes to the report or its surveys make a cached page
+# stale. The first request for a stale page re-renders it while other
+# requests keep getting the stale page for up to REPORT_CACHE_MAX_STALE more
+# seconds. Logged in users always see a fresh report, and pages that
+# render a csrf token aren't cached. None turns the cache off.
+REPORT_CACHE_TIMEOUT = getattr(_gs, 'CROWDSOURCING_REPORT_CACHE_TIMEOUT', None)
+
+REPORT_CACHE_MAX_STALE = getattr(_gs,
+                                 'CROWDSOURCING_REPORT_CACHE_MAX_STALE',
+                                 10 * 60)
+
+
+# Streaming exports from the submissions view read this many submissions and
+# their answers at a time.
+EXPORT_CHUNK_SIZE = getattr(_gs, 'CROWDSOURCING_EXPORT_CHUNK_SIZE', 1000)
+
+
+# Page through report submissions by where the last page left off instead of
+# by page number. Deep pages cost no more than the first, and there's no
+# COUNT query, but the report links only to the previous and next pages. This
+# doesn't apply to reports with PRE_REPORT sorting or a result limit.
+KEYSET_PAGINATION = getattr(_gs, 'CROWDSOURCING_KEYSET_PAGINATION', False)
+
+# How long to cache the total from KeysetPage.count.
+KEYSET_COUNT_TIMEOUT = getattr(_gs,
+                               'CROWDSOURCING_KEYSET_COUNT_TIMEOUT',
+                               5 * 60)
+
+
+# Report filters run once per request and survey. If they match at most this
+# many submissions, every display on the page gets the matching ids inline in
+# its query instead of running the filters again as a subquery. Use 0 to
+# always use the subquery.
+FILTER_INLINE_IDS = getattr(_gs, 'CROWDSOURCING_FILTER_INLINE_IDS', 1000)
+
+
+# Keep bitmaps of which submissions gave each answer to choice questions in
+# the cache for this many seconds, and count filtered pie charts from them
+# instead of the database. New answers and submissions are added to them, and
+# any changed or deleted answer or submission starts them over. None turns
+# this off.
+BITMAP_INDEX_TIMEOUT = getattr(_gs, 'CROWDSOURCING_BITMAP_INDEX_TIMEOUT', None)
+
+
+# The python path of the class that geocodes locations. Subclass
+# crowdsourcing.geo.Geocoder and implement geocode, which takes a location
+# and returns (latitude, longitude). Crowdsourcing comes with
+# crowdsourcing.geo.GoogleGeocoder, which uses geopy, and
+# crowdsourcing.geo.GazetteerGeocoder, which reads GAZETTEER_FILE.
+GEOCODER = getattr(_gs,
+                   'CROWDSOURCING_GEOCODER',
+                   'crowdsourcing.geo.GoogleGeocoder')
+
+# A csv file of location, latitude, and longitude rows for GazetteerGeocoder.
+GAZETTEER_FILE = getattr(_gs, 'CROWDSOURCING_GAZETTEER_FILE', '')
+
+# How many queued location answers the GeocodePending task geocodes each
+# time it runs.
+GEOCODE_BATCH_SIZE = getattr(_gs, 'CROWDSOURCING_GEOCODE_BATCH_SIZE', 100)
+
+# Wait this many seconds between requests to the geocoding service when
+# geocoding more than one location at a time.
+GEOCODE_INTERVAL = getattr(_gs, 'CROWDSOURCING_GEOCODE_INTERVAL', 0.2)
+
+
+# If this is False, submitting a location that hasn't been geocoded before
+# doesn't wait for the geocoder. The answer goes in a queue that the
+# GeocodePending task works through GEOCODE_BATCH_SIZE answers at a time.
+# Answers the geocoder fails on go in the same queue either way.
+SYNCHRONOUS_GEOCODING = getattr(_gs, 'CROWDSOURCING_SYNCHRONOUS_GEOCODING', True)
+
+# The GeocodePending task retries an answer the geocoder failed on after this
+# many seconds, doubling the wait each time, and gives up after
+# GEOCODE_MAX_ATTEMPTS tries.
+GEOCODE_RETRY_SECONDS = getattr(_gs, 'CROWDSOURCING_GEOCODE_RETRY_SECONDS', 60)
+
+GEOCODE_MAX_ATTEMPTS = getattr(_gs, 'CROWDSOURCING_GEOCODE_MAX_ATTEMPTS', 8)
+
+
+# A map tile with more than this many points lists clusters of points instead
+# of the points themselves.
+MAP_TILE_POINTS = getattr(_gs, 'CROWDSOURCING_MAP_TILE_POINTS', 200)
+
+
+# The questions, allowed_actions, embeded_survey_report, and
+# location_question_results views send ETag and Last-Modified headers, answer
+# conditional GETs with 304 Not Modified, and let browsers and CDNs cache
+# them for this many seconds. Staff always get a fresh response. None turns
+# this off.
+HTTP_CACHE_TIMEOUT = getattr(_gs, 'CROWDSOURCING_HTTP_CACHE_TIMEOUT', None)
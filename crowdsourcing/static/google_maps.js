@@ -10,12 +10,14 @@ function setupMap(
     if (GBrowserIsCompatible()) {
       $(function() {
         var params = queryParametersAsLookup();
+        params.compact = 1;
         $.getJSON(results_url, params, function(data, status) {
           if (status != "success") {
             $("#" + div_id).html("The crowdsourcing API is experiencing "
               + "problems. It returned status " + status + ".");
             return;
           }
+          data.entries = expandMapEntries(data);
           if (!data.entries.length) {
             $("#" + div_id).html("There aren't any locations to show on "
               + "this map, but as soon as we get some we'll put a map here.");
@@ -48,6 +50,24 @@ function setupMap(
   googleMapCallbacks.push(onAPILoaded);
 }
 
+// Turn the compact payload, which has a list for each field and the url
+// once, into the usual list of entries.
+function expandMapEntries(data) {
+  if (data.entries) {
+    return data.entries;
+  }
+  var entries = [];
+  for (var i = 0; i < data.ids.length; i++) {
+    var icon = data.icon[i];
+    entries.push({
+      lat: data.lat[i],
+      lng: data.lng[i],
+      url: data.url.replace("{id}", data.ids[i]),
+      icon: null == icon ? null : data.icons[icon]});
+  }
+  return entries;
+}
+
 function showSubmission(url, div_id, details_id) {
   var img = '<img class="loading" src="/media/img/loading.gif" ' +
       'alt="loading" />';
@@ -7,7 +7,8 @@ except ImportError:
 
 from datetime import timedelta
 import logging
-from .models import Answer
+from .models import Answer, PendingGeocode
+from .views import ingest_pending_submissions, send_pending_survey_emails
 from . import settings as local_settings
 
 logger = logging.getLogger('crowdsourcing.tasks')
@@ -21,3 +22,38 @@ class SyncFlickr(PeriodicTask):
 
 if tasks and not local_settings.SYNCHRONOUS_FLICKR_UPLOAD:
     tasks.register(SyncFlickr)
+
+
+class IngestSubmissions(PeriodicTask):
+    run_every = timedelta(seconds=10)
+
+    def run(self, *args, **kwargs):
+        logger.debug("Ingesting pending submissions")
+        # Keep draining until there is nothing left to claim.
+        while ingest_pending_submissions():
+            pass
+
+if tasks and local_settings.ASYNC_SUBMISSIONS:
+    tasks.register(IngestSubmissions)
+
+
+class SendSurveyEmails(PeriodicTask):
+    run_every = timedelta(minutes=1)
+
+    def run(self, *args, **kwargs):
+        logger.debug("Sending survey notification emails")
+        send_pending_survey_emails()
+
+if tasks and not local_settings.SYNCHRONOUS_SURVEY_EMAIL:
+    tasks.register(SendSurveyEmails)
+
+
+class GeocodePending(PeriodicTask):
+    run_every = timedelta(minutes=1)
+
+    def run(self, *args, **kwargs):
+        logger.debug("Geocoding pending location answers")
+        PendingGeocode.geocode_pending()
+
+if tasks:
+    tasks.register(GeocodePending)
@@ -760,6 +760,17 @@ register.simple_tag(submission_link)
 
 def paginator(survey, report, pages_to_link, page_obj):
     out = []
+    if getattr(page_obj, "is_keyset", False):
+        if page_obj.has_other_pages():
+            out.append('<div class="pages">')
+            if page_obj.has_previous():
+                url = escape("?" + page_obj.previous_query())
+                out.append('<a href="%s">&laquo; Previous</a>' % url)
+            if page_obj.has_next():
+                url = escape("?" + page_obj.next_query())
+                out.append('<a href="%s">Next &raquo;</a>' % url)
+            out.append("</div>")
+        return mark_safe("\n".join(out))
     url_args = dict(slug=survey.slug, page=0)
     view_name = "survey_default_report"
     if report.slug:
@@ -3,9 +3,50 @@ run these tests with nose.
 """
 
 from __future__ import absolute_import
+import csv
+import datetime
+import gzip
+import imp
+import json
+import logging
+import os
+import smtplib
+from StringIO import StringIO
+import sys
+import tempfile
+import time
 import unittest
+from urlparse import parse_qsl, urlparse
 
-from .models import Survey, Question, Answer, Submission
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connection
+from django.http import HttpResponse, QueryDict
+from django.middleware.csrf import get_token
+from django.template.response import TemplateResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from . import geo
+from .cacheutils import get_version, versioned_key
+from .forms import compiled_forms_for_survey, forms_for_survey
+from .geo import QUADKEY_ZOOM, Geocoder, GazetteerGeocoder, quadkey
+from .models import (ARCHIVE_POLICY_CHOICES, FORMAT_CHOICES,
+                     OPTION_TYPE_CHOICES, AggregateResultSum, AnswerBitmaps,
+                     AnswerCount, GeocodedLocation, PendingGeocode,
+                     PendingSubmission, PendingSurveyEmail, Survey,
+                     SurveyReport, Question, Answer, Submission,
+                     _bounding_box, extra_from_filters,
+                     filtered_submission_ids)
+from .util import atomic
+from .views import (_cached_report, ingest_pending_submissions,
+                    send_pending_survey_emails)
+from . import views
+from . import settings as local_settings
 
 class SurveyTestCase(unittest.TestCase):
     def setUp(self):
@@ -80,3 +121,1095 @@ class SubmissionTestCase(SurveyTestCase):
         self.assertEquals(answer.text_answer, e)
         self.assertEquals(self.submission.email, e)        
         
+
+
+def _override_settings(test, **kwargs):
+    """ Change crowdsourcing.settings until the test finishes. """
+    for name, value in kwargs.items():
+        test.addCleanup(setattr, local_settings, name,
+                        getattr(local_settings, name))
+        setattr(local_settings, name, value)
+
+
+def _make_survey(slug="cached", **kwargs):
+    kwargs.setdefault("archive_policy", ARCHIVE_POLICY_CHOICES.IMMEDIATE)
+    kwargs.setdefault("starts_at", datetime.datetime(2010, 1, 1))
+    survey = Survey.objects.create(title=slug.title(),
+                                   slug=slug,
+                                   is_published=True,
+                                   site=Site.objects.get_current(),
+                                   **kwargs)
+    survey.questions.create(fieldname="color",
+                            question="What is your favorite color?",
+                            label="Color",
+                            order=1,
+                            option_type=OPTION_TYPE_CHOICES.CHOICE,
+                            options="red\nblue\ngreen")
+    survey.questions.create(fieldname="where",
+                            question="Where are you?",
+                            label="Where",
+                            order=2,
+                            option_type=OPTION_TYPE_CHOICES.LOCATION)
+    return survey
+
+
+def _submit(survey, is_public=True, **answers):
+    submission = Submission(survey=survey,
+                            ip_address="127.0.0.1",
+                            is_public=is_public)
+    questions = dict((q.fieldname, q) for q in survey.questions.all())
+    rows = []
+    for fieldname, value in answers.items():
+        answer = Answer(question=questions[fieldname])
+        answer.value = value
+        rows.append(answer)
+    submission.save_with_answers(rows)
+    return submission
+
+
+class ReportCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        _override_settings(self, REPORT_CACHE_TIMEOUT=60)
+        self.renders = []
+
+    def _get(self, user=None, content="report"):
+        request = RequestFactory().get("/report/")
+        request.user = user or AnonymousUser()
+
+        def render():
+            self.renders.append(request)
+            if "csrf" == content:
+                return get_token(request)
+            return content
+        return _cached_report(request, "key", ["version"], render)
+
+    def testAnonymousShareCachedPage(self):
+        self._get()
+        self.assertEquals(self._get(content="changed"), "report")
+        self.assertEquals(len(self.renders), 1)
+
+    def testLoggedInUsersRenderFresh(self):
+        user = User.objects.create_user("pat", "pat@example.com", "pw")
+        self._get()
+        self.assertEquals(self._get(user, content="mine"), "mine")
+        self._get(user)
+        self.assertEquals(len(self.renders), 3)
+
+    def testPagesWithCsrfTokensAreNotCached(self):
+        self._get(content="csrf")
+        self._get()
+        self.assertEquals(len(self.renders), 2)
+
+
+class SurveyReportViewTestCase(TestCase):
+    def setUp(self):
+        self.survey = _make_survey()
+        self.report = SurveyReport.objects.create(title="Report",
+                                                  slug="report")
+        self.report.survey.add(self.survey)
+
+    def testUncachedReportsAreTemplateResponses(self):
+        _override_settings(self, REPORT_CACHE_TIMEOUT=None)
+        request = RequestFactory().get("/report/")
+        request.user = AnonymousUser()
+        response = views.SurveyReportView.as_view()(request, slug="report")
+        self.assertTrue(isinstance(response, TemplateResponse))
+        self.assertFalse(response.is_rendered)
+
+
+class DataVersionTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        _override_settings(self, REPORT_CACHE_TIMEOUT=60)
+        self.survey = _make_survey()
+
+    def testBumpWaitsForCommit(self):
+        before = self.survey.get_data_version()
+        with atomic():
+            _submit(self.survey, color="red")
+            self.assertEquals(self.survey.get_data_version(), before)
+        self.assertNotEquals(self.survey.get_data_version(), before)
+
+    def testModerationBumps(self):
+        submission = _submit(self.survey, color="red")
+        before = self.survey.get_data_version()
+        submission.is_public = False
+        submission.save()
+        self.assertNotEquals(self.survey.get_data_version(), before)
+
+
+class AnswerBitmapsTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        _override_settings(self, BITMAP_INDEX_TIMEOUT=60)
+        self.survey = _make_survey()
+        self.color = self.survey.questions.get(fieldname="color")
+
+    def _red(self):
+        bitmap = AnswerBitmaps.for_question(self.color)
+        return bitmap.get(AnswerCount.key_for("red"), 0)
+
+    def _submit_with_answer_id(self, answer_id):
+        submission = Submission.objects.create(survey=self.survey,
+                                               ip_address="127.0.0.1")
+        answer = Answer(id=answer_id, question=self.color)
+        answer.value = "red"
+        submission.save_with_answers([answer])
+        return submission
+
+    def testAnswerCommittedOutOfIdOrder(self):
+        later = self._submit_with_answer_id(100)
+        self.assertEquals(self._red(), 1 << later.id)
+        earlier = self._submit_with_answer_id(50)
+        self.assertEquals(self._red(), (1 << later.id) | (1 << earlier.id))
+
+    def testNewAnswersDontStartOver(self):
+        first = self._submit_with_answer_id(1)
+        self.assertEquals(self._red(), 1 << first.id)
+        version = get_version("bitmaps_question_%d" % self.color.id)
+        second = self._submit_with_answer_id(2)
+        self.assertEquals(get_version("bitmaps_question_%d" % self.color.id),
+                          version)
+        with self.assertNumQueries(0):
+            self.assertEquals(self._red(), (1 << first.id) | (1 << second.id))
+        public = AnswerBitmaps.for_survey(self.survey.id)["public"]
+        self.assertEquals(public, (1 << first.id) | (1 << second.id))
+
+    def testEditedAnswersStartOver(self):
+        submission = self._submit_with_answer_id(1)
+        self.assertEquals(self._red(), 1 << submission.id)
+        answer = Answer.objects.get(pk=1)
+        answer.text_answer = "blue"
+        answer.save()
+        self.assertEquals(self._red(), 0)
+
+    def testModerationForgetsSurveyBitmaps(self):
+        submission = self._submit_with_answer_id(1)
+        public = AnswerBitmaps.for_survey(self.survey.id)["public"]
+        self.assertEquals(public, 1 << submission.id)
+        submission.is_public = False
+        submission.save()
+        self.assertEquals(AnswerBitmaps.for_survey(self.survey.id)["public"],
+                          0)
+
+
+class IngestPendingSubmissionsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = _make_survey()
+        self.color = self.survey.questions.get(fieldname="color")
+        for color in ("red", "blue", "green"):
+            submission = Submission(survey=self.survey,
+                                    ip_address="127.0.0.1")
+            answer = Answer(question=self.color)
+            answer.value = color
+            PendingSubmission.from_submission(submission,
+                                              [answer],
+                                              "example.com").save()
+
+    def testIngestWritesAndDequeues(self):
+        self.assertEquals(ingest_pending_submissions(), 3)
+        self.assertEquals(PendingSubmission.objects.count(), 0)
+        colors = Answer.objects.values_list("text_answer", flat=True)
+        self.assertEquals(sorted(colors), ["blue", "green", "red"])
+
+    def testClaimedRowsAreSkipped(self):
+        claimed = PendingSubmission.claim(2)
+        self.assertEquals(ingest_pending_submissions(), 1)
+        self.assertEquals(ingest_pending_submissions(), 0)
+        self.assertEquals(Submission.objects.count(), 1)
+        self.assertEquals(
+            sorted(PendingSubmission.objects.values_list("pk", flat=True)),
+            sorted(p.pk for p in claimed))
+
+    def testStaleClaimsAreRetried(self):
+        PendingSubmission.claim(3)
+        stale = datetime.datetime.now() - datetime.timedelta(
+            seconds=PendingSubmission.CLAIM_TIMEOUT + 1)
+        PendingSubmission.objects.update(claimed_at=stale)
+        self.assertEquals(ingest_pending_submissions(), 3)
+
+    def testBadRowsDontBlockTheQueue(self):
+        bad = PendingSubmission.objects.all()[1]
+        bad.answer_data = "not json"
+        bad.save()
+        self.assertEquals(ingest_pending_submissions(), 3)
+        self.assertEquals(ingest_pending_submissions(), 0)
+        colors = Answer.objects.values_list("text_answer", flat=True)
+        self.assertEquals(sorted(colors), ["green", "red"])
+        failed = PendingSubmission.objects.get()
+        self.assertEquals(failed.pk, bad.pk)
+        self.assertTrue(failed.failed_at)
+        self.assertTrue(failed.error)
+
+
+class CanQueueTestCase(TestCase):
+    def setUp(self):
+        _override_settings(self, ASYNC_SUBMISSIONS=True)
+        self.survey = _make_survey()
+        self.color = self.survey.questions.get(fieldname="color")
+
+    def _can_queue(self):
+        submission = Submission(survey=self.survey, ip_address="127.0.0.1")
+        answer = Answer(question=self.color)
+        answer.value = "red"
+        return views._can_queue(submission, [answer])
+
+    def testNewSubmissionsQueue(self):
+        self.assertTrue(self._can_queue())
+
+    def testChangeableSurveysWriteRightAway(self):
+        self.survey.allow_response_change = True
+        self.assertFalse(self._can_queue())
+
+
+class SendPendingSurveyEmailsTestCase(TestCase):
+    urls = "crowdsourcing.urls"
+
+    def setUp(self):
+        self.survey = _make_survey(email="editor@example.com")
+
+    def _queue(self, n, minutes_ago=0):
+        created_at = (datetime.datetime.now() -
+                      datetime.timedelta(minutes=minutes_ago))
+        for i in range(n):
+            submission = _submit(self.survey, color="red")
+            PendingSurveyEmail.objects.create(survey=self.survey,
+                                              submission=submission,
+                                              host="example.com",
+                                              created_at=created_at)
+
+    def testOneEmailPerSubmission(self):
+        self._queue(3)
+        self.assertEquals(send_pending_survey_emails(), 3)
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertEquals(PendingSurveyEmail.objects.count(), 0)
+
+    def testDigestPerSizeSubmissions(self):
+        self.survey.email_digest_size = 2
+        self.survey.save()
+        self._queue(5)
+        self.assertEquals(send_pending_survey_emails(), 4)
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(PendingSurveyEmail.objects.count(), 1)
+
+    def testExpiredWindowSendsTheRest(self):
+        self.survey.email_digest_size = 2
+        self.survey.email_digest_minutes = 10
+        self.survey.save()
+        self._queue(3, minutes_ago=11)
+        self.assertEquals(send_pending_survey_emails(), 3)
+        self.assertEquals(len(mail.outbox), 2)
+
+    def testFailedSendStaysQueued(self):
+        self._queue(2)
+        connection = mail.get_connection()
+
+        def fail(messages):
+            raise smtplib.SMTPException("relay down")
+        connection.send_messages = fail
+        get_connection = views.get_connection
+        views.get_connection = lambda: connection
+        try:
+            self.assertEquals(send_pending_survey_emails(), 0)
+        finally:
+            views.get_connection = get_connection
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(
+            PendingSurveyEmail.objects.filter(claimed_by="").count(), 2)
+        self.assertEquals(send_pending_survey_emails(), 2)
+
+    def testClaimedEmailsAreSkipped(self):
+        self._queue(2)
+        PendingSurveyEmail.claim(1)
+        self.assertEquals(send_pending_survey_emails(), 1)
+        self.assertEquals(len(mail.outbox), 1)
+
+
+def _use_gazetteer(test):
+    """ Geocode from a little gazetteer file until the test finishes. """
+    gazetteer = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+    test.addCleanup(os.remove, gazetteer.name)
+    gazetteer.write("New York, NY,40.71,-74.0\n"
+                    "# comment,0,0\n"
+                    "Springfield,39.8,-89.64\n")
+    gazetteer.close()
+    _override_settings(test,
+                       GEOCODER="crowdsourcing.geo.GazetteerGeocoder",
+                       GAZETTEER_FILE=gazetteer.name)
+    test.addCleanup(setattr, geo, "_geocoder", None)
+    geo._geocoder = None
+    return gazetteer.name
+
+
+class DownGeocoder(Geocoder):
+    def geocode(self, location):
+        raise IOError("service unavailable")
+
+
+class GeocoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.geocoder = GazetteerGeocoder(_use_gazetteer(self))
+
+    def testGazetteerIgnoresCaseAndSpacing(self):
+        self.assertEquals(self.geocoder.geocode("new york,   ny"),
+                          (40.71, -74.0))
+        self.assertEquals(self.geocoder.geocode("Atlantis"), (None, None))
+
+    def testGeocodeManyLeavesOutFailures(self):
+        class Flaky(Geocoder):
+            def geocode(self, location):
+                if "down" == location:
+                    raise IOError("service unavailable")
+                return 1.0, 2.0
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.assertEquals(Flaky().geocode_many(["up", "down"]),
+                          {"up": (1.0, 2.0)})
+        self.assertEquals(
+            self.geocoder.geocode_many(["Springfield", "Atlantis"]),
+            {"Springfield": (39.8, -89.64), "Atlantis": (None, None)})
+
+
+class PendingGeocodeTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        _use_gazetteer(self)
+        _override_settings(self, HTTP_CACHE_TIMEOUT=60)
+        self.survey = _make_survey()
+
+    def testQueueMissingFillsOldAnswers(self):
+        submission = _submit(self.survey, color="red")
+        where = self.survey.questions.get(fieldname="where")
+        submission.answer_set.create(question=where,
+                                     text_answer="new york,  ny")
+        self.assertEquals(PendingGeocode.queue_missing(), 1)
+        self.assertEquals(PendingGeocode.queue_missing(), 0)
+        before = self.survey.get_data_version()
+        self.assertEquals(PendingGeocode.geocode_pending(), 1)
+        answer = Answer.objects.get(question=where)
+        self.assertEquals((answer.latitude, answer.longitude), (40.71, -74.0))
+        self.assertEquals(PendingGeocode.objects.count(), 0)
+        self.assertNotEquals(self.survey.get_data_version(), before)
+
+    def testFailuresAreRetriedWithBackoff(self):
+        _override_settings(self,
+                           GEOCODER="crowdsourcing.tests.DownGeocoder",
+                           GEOCODE_RETRY_SECONDS=60)
+        geo._geocoder = None
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        _submit(self.survey, where="Springfield")
+        pending = PendingGeocode.objects.get()
+        self.assertEquals(PendingGeocode.geocode_pending(), 1)
+        pending = PendingGeocode.objects.get(pk=pending.pk)
+        self.assertEquals(pending.attempts, 1)
+        self.assertEquals(pending.claimed_by, "")
+        self.assertTrue(pending.next_attempt_at > datetime.datetime.now())
+        self.assertEquals(PendingGeocode.geocode_pending(), 0)
+
+        _use_gazetteer(self)
+        PendingGeocode.objects.update(next_attempt_at=datetime.datetime.now())
+        self.assertEquals(PendingGeocode.geocode_pending(), 1)
+        answer = Answer.objects.get(question__fieldname="where")
+        self.assertEquals((answer.latitude, answer.longitude), (39.8, -89.64))
+
+    def testDeferredGeocoding(self):
+        _override_settings(self, SYNCHRONOUS_GEOCODING=False)
+        _submit(self.survey, where="Springfield")
+        answer = Answer.objects.get(question__fieldname="where")
+        self.assertEquals(answer.latitude, None)
+        self.assertEquals(PendingGeocode.geocode_pending(), 1)
+        answer = Answer.objects.get(pk=answer.pk)
+        self.assertEquals(answer.latitude, 39.8)
+
+    def testClaimedAnswersAreSkipped(self):
+        _override_settings(self, SYNCHRONOUS_GEOCODING=False)
+        _submit(self.survey, where="Springfield")
+        PendingGeocode.claim(1)
+        self.assertEquals(PendingGeocode.geocode_pending(), 0)
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        _override_settings(self, HTTP_CACHE_TIMEOUT=60)
+        self.versions = [time.time() - 10]
+
+    def _get(self, since=None, content="data"):
+        @views.conditional_get(lambda request: self.versions)
+        def view(request):
+            if "csrf" == content:
+                return HttpResponse(get_token(request))
+            return HttpResponse(content)
+        request = RequestFactory().get("/data/")
+        request.user = AnonymousUser()
+        if since:
+            request.META["HTTP_IF_MODIFIED_SINCE"] = since
+        return view(request)
+
+    def testNotModifiedSince(self):
+        since = self._get()["Last-Modified"]
+        self.assertEquals(self._get(since).status_code, 304)
+        self.versions = [time.time()]
+        self.assertEquals(self._get(since).status_code, 200)
+
+    def testBumpInTheSameSecondIsModified(self):
+        self.versions = [time.time()]
+        since = self._get()["Last-Modified"]
+        self.versions = [self.versions[0] + 0.001]
+        self.assertEquals(self._get(since).status_code, 200)
+
+    def testPagesWithCsrfTokensAreNotCached(self):
+        response = self._get(content="csrf")
+        self.assertFalse(response.has_header("ETag"))
+        self.assertFalse(response.has_header("Cache-Control"))
+
+    def testLoggedInUsersDontShareReports(self):
+        survey = _make_survey()
+        request = RequestFactory().get("/report/")
+        request.user = AnonymousUser()
+        self.assertTrue(views._embeded_survey_report_versions(request,
+                                                              survey.slug))
+        request.user = User.objects.create_user("pat", "pat@example.com", "pw")
+        self.assertEquals(
+            views._embeded_survey_report_versions(request, survey.slug), None)
+
+
+class CoordinatesBumpTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        _use_gazetteer(self)
+        _override_settings(self, HTTP_CACHE_TIMEOUT=60)
+        self.survey = _make_survey()
+
+    def testGeocodingBumpsDataVersion(self):
+        submission = _submit(self.survey, where="Springfield")
+        before = self.survey.get_data_version()
+        submission.answers_committed(list(submission.answer_set.all()))
+        self.assertNotEquals(self.survey.get_data_version(), before)
+
+
+class LocationMapTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        _use_gazetteer(self)
+        _override_settings(self, MAP_TILE_POINTS=1)
+        self.survey = _make_survey()
+        self.where = self.survey.questions.get(fieldname="where")
+        for i in range(3):
+            _submit(self.survey, where="Springfield")
+
+    def _get(self, view, *args, **params):
+        request = RequestFactory().get("/map/", params)
+        request.user = AnonymousUser()
+        return json.loads(view(request, self.where.id, *args).content)
+
+    def _tile(self, z, x, y, **params):
+        return self._get(views.location_question_tile, z, x, y, **params)
+
+    def testIconsComeFromThePointsSubmissions(self):
+        color = self.survey.questions.get(fieldname="color")
+        color.map_icons = "red.png\nblue.png"
+        color.save()
+        _submit(self.survey, color="blue", where="Springfield")
+        _submit(self.survey, color="green", where="Springfield")
+        _submit(self.survey, is_public=False, color="red",
+                where="Springfield")
+        with CaptureQueriesContext(connection) as context:
+            entries = self._get(views.location_question_results, "")
+        # Only the five public points' submissions get looked up.
+        points = '"submission_id" IN (%s, %s, %s, %s, %s)'
+        icon_queries = [q for q in context.captured_queries
+                        if points in q["sql"]]
+        self.assertEquals(len(icon_queries), 1)
+        self.assertEquals([e.get("icon") for e in entries["entries"]],
+                          [None, "blue.png", None, None, None])
+
+    def testBusyTilesCluster(self):
+        entries = self._tile(0, 0, 0)["entries"]
+        self.assertEquals(entries, [dict(lat=39.8, lng=-89.64, count=3)])
+
+    def testTileProbeDoesntSort(self):
+        with CaptureQueriesContext(connection) as context:
+            self._tile(0, 0, 0)
+        probes = [q["sql"] for q in context.captured_queries
+                  if "LIMIT 2" in q["sql"]]
+        self.assertEquals(len(probes), 1)
+        self.assertFalse("ORDER BY" in probes[0])
+
+    def testTilesAreConditional(self):
+        _override_settings(self, HTTP_CACHE_TIMEOUT=60)
+
+        def get(etag=None):
+            request = RequestFactory().get("/map/")
+            request.user = AnonymousUser()
+            if etag:
+                request.META["HTTP_IF_NONE_MATCH"] = etag
+            return views.location_question_tile(request, self.where.id,
+                                                0, 0, 0)
+        etag = get()["ETag"]
+        self.assertEquals(get(etag).status_code, 304)
+        _submit(self.survey, where="Springfield")
+        self.assertEquals(get(etag).status_code, 200)
+
+    def testDeepestZoomIsOneCluster(self):
+        x = y = 0
+        for digit in quadkey(39.8, -89.64):
+            x, y = x * 2 + int(digit) % 2, y * 2 + int(digit) // 2
+        entries = self._tile(QUADKEY_ZOOM, x, y)["entries"]
+        self.assertEquals(entries, [dict(lat=39.8, lng=-89.64, count=3)])
+
+    def testCompactOnlyWhenAskedFor(self):
+        view = views.location_question_results
+        self.assertTrue("entries" in self._get(view, "", compact="0"))
+        self.assertTrue("entries" in self._get(view, "", compact="false"))
+        compact = self._get(view, "", compact="true")
+        self.assertEquals(compact["lat"], [39.8] * 3)
+
+
+class AllowOriginTestCase(TransactionTestCase):
+    def _allowed(self, origin):
+        with self.settings(ADDITIONAL_CORS_SITES=["partner.example.com",
+                                                  "http://localhost:8000"]):
+            matcher = views.OriginMatcher(views.allow_origin_sites())
+        return matcher.allowed(origin)
+
+    def testSitesWithoutSchemeAllowBoth(self):
+        self.assertEquals(self._allowed("https://partner.example.com/page"),
+                          ["https://partner.example.com"])
+        self.assertEquals(self._allowed("http://partner.example.com"),
+                          ["http://partner.example.com"])
+
+    def testPortsMatch(self):
+        self.assertEquals(self._allowed("http://localhost:8000/embed"),
+                          ["http://localhost:8000"])
+        self.assertEquals(self._allowed("http://localhost:9000/embed"), [])
+        self.assertEquals(self._allowed("http://elsewhere.example.com"), [])
+
+    def testSiteChangesRebuildTheMatcher(self):
+        cache.clear()
+        self.addCleanup(setattr, views, "_origin_matcher", None)
+        matcher = views.get_origin_matcher()
+        self.assertTrue(views.get_origin_matcher() is matcher)
+        Site.objects.create(domain="new.example.com", name="New")
+        self.assertEquals(
+            views.get_origin_matcher().allowed("https://new.example.com/"),
+            ["https://new.example.com"])
+
+
+class FilterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        _use_gazetteer(self)
+        self.survey = _make_survey()
+        self.survey.questions.create(fieldname="size",
+                                     question="What size?",
+                                     label="Size",
+                                     order=3,
+                                     option_type=OPTION_TYPE_CHOICES.CHOICE,
+                                     options="big\nsmall")
+        self.big = _submit(self.survey, color="red", size="big")
+        _submit(self.survey, color="red", size="small")
+
+    def _filtered(self, **request_data):
+        return list(extra_from_filters(Submission.objects.all(),
+                                       "crowdsourcing_submission.id",
+                                       self.survey,
+                                       request_data))
+
+    def testUnknownLocationSkipsOnlyItsFilter(self):
+        self.assertEquals(self._filtered(where_location="Atlantis",
+                                         where_within="10",
+                                         size="big"),
+                          [self.big])
+
+    def testFiltersRunOncePerRequest(self):
+        request_data = QueryDict("size=big")
+        ids, sql, params = filtered_submission_ids(self.survey, request_data)
+        self.assertEquals(ids, [self.big.id])
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                filtered_submission_ids(self.survey, request_data)[0],
+                [self.big.id])
+
+    def testManyMatchesUseTheSubquery(self):
+        _override_settings(self, FILTER_INLINE_IDS=1)
+        request_data = QueryDict("color=red")
+        ids, sql, params = filtered_submission_ids(self.survey, request_data)
+        self.assertEquals(ids, None)
+        self.assertEquals(len(self._filtered(color="red")), 2)
+
+
+class AnswerCountTestCase(TestCase):
+    def setUp(self):
+        _override_settings(self, MATERIALIZED_COUNTS=True)
+        self.survey = _make_survey()
+        self.color = self.survey.questions.get(fieldname="color")
+
+    def _count(self, value):
+        counts = AnswerCount.objects.filter(question=self.color, value=value)
+        return sum(counts.values_list("count", flat=True))
+
+    def testReplacingAnswersRecounts(self):
+        submission = _submit(self.survey, color="red")
+        answer = Answer(question=self.color)
+        answer.value = "blue"
+        submission.save_with_answers([answer], replace_questions=[self.color])
+        self.assertEquals((self._count("red"), self._count("blue")), (0, 1))
+
+    def testDeleteAnswersUncountsInBulk(self):
+        def queries(answers):
+            with CaptureQueriesContext(connection) as context:
+                Answer.delete_answers(answers)
+            return len(context)
+        for color in ("red", "red", "blue", "red"):
+            _submit(self.survey, color=color)
+        one = queries(Answer.objects.filter(text_answer="blue"))
+        self.assertEquals(queries(Answer.objects.filter(text_answer="red")),
+                          one)
+        self.assertEquals((self._count("red"), self._count("blue")), (0, 0))
+
+
+class SchemaCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = _make_survey()
+
+    def testSchemaIsCachedWithoutTheSurvey(self):
+        self.survey.get_fields()
+        key = versioned_key("survey_schema",
+                            self.survey.get_schema_version(),
+                            self.survey.pk)
+        cached = cache.get(key)
+        self.assertEquals([q.fieldname for q in cached], ["color", "where"])
+        self.assertFalse([q for q in cached if "_survey_cache" in q.__dict__])
+
+    def testSchemaFromCacheDoesntQuery(self):
+        self.survey.get_fields()
+        survey = Survey.objects.get(pk=self.survey.pk)
+        with self.assertNumQueries(0):
+            fields = survey.get_fields()
+            self.assertEquals(fields[1].parsed_options, [])
+            self.assertTrue(fields[0].survey is survey)
+
+    def testSchemaVersionWaitsForCommit(self):
+        before = self.survey.get_schema_version()
+        with atomic():
+            color = self.survey.questions.get(fieldname="color")
+            color.label = "Colour"
+            color.save()
+            self.assertEquals(self.survey.get_schema_version(), before)
+        self.assertNotEquals(self.survey.get_schema_version(), before)
+
+    def testSavingAQuestionInvalidatesTheSchema(self):
+        self.survey.get_fields()
+        color = self.survey.questions.get(fieldname="color")
+        color.label = "Colour"
+        color.save()
+        survey = Survey.objects.get(pk=self.survey.pk)
+        self.assertEquals(survey.get_fields()[0].label, "Colour")
+
+
+class SaveWithAnswersTestCase(TransactionTestCase):
+    def setUp(self):
+        _use_gazetteer(self)
+        self.survey = _make_survey()
+
+    def testAnswersInsertTogether(self):
+        with CaptureQueriesContext(connection) as context:
+            submission = _submit(self.survey, color="red", where="Springfield")
+        inserts = [q for q in context.captured_queries
+                   if 'INSERT INTO "crowdsourcing_answer"' in q["sql"]]
+        self.assertEquals(len(inserts), 1)
+        where = submission.answer_set.get(question__fieldname="where")
+        self.assertEquals((where.latitude, where.longitude), (39.8, -89.64))
+
+    def testGeocodingWaitsForCommit(self):
+        with atomic():
+            submission = _submit(self.survey, where="Springfield")
+            where = submission.answer_set.get()
+            self.assertEquals(where.latitude, None)
+        where = submission.answer_set.get()
+        self.assertEquals((where.latitude, where.longitude), (39.8, -89.64))
+
+    def testFailedAnswerRollsBackTheSubmission(self):
+        submission = Submission(survey=self.survey, ip_address="127.0.0.1")
+        self.assertRaises(IntegrityError,
+                          submission.save_with_answers,
+                          [Answer(text_answer="no question")])
+        self.assertEquals(Submission.objects.count(), 0)
+
+
+class SurveyFormsTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = _make_survey()
+        self.color = self.survey.questions.get(fieldname="color")
+
+    def _post(self, **data):
+        request = RequestFactory().post("/", data)
+        request.user = AnonymousUser()
+        return forms_for_survey(Survey.objects.get(pk=self.survey.pk),
+                                request)
+
+    def testFormClassesCompileOncePerSchema(self):
+        form_classes = compiled_forms_for_survey(self.survey)
+        self.assertTrue(compiled_forms_for_survey(self.survey)[0]
+                        is form_classes[0])
+        self.color.question = "Which color?"
+        self.color.save()
+        survey = Survey.objects.get(pk=self.survey.pk)
+        recompiled = compiled_forms_for_survey(survey)
+        self.assertFalse(recompiled[0] is form_classes[0])
+        self.assertEquals(recompiled[0].base_fields["answer"].label,
+                          "Which color?")
+
+    def testCompiledFormsValidate(self):
+        field = "%d_%d-answer" % (self.survey.id, self.color.id)
+        color_form = self._post(**{field: "red"})[0]
+        self.assertTrue(color_form.is_valid())
+        self.assertEquals(color_form.cleaned_data["answer"], ["red"])
+        self.assertFalse(self._post(**{field: "purple"})[0].is_valid())
+
+    def testEditingLoadsAnswersOnce(self):
+        _use_gazetteer(self)
+        submission = _submit(self.survey, color="blue", where="Springfield")
+        submission = Submission.objects.get(pk=submission.pk)
+        with CaptureQueriesContext(connection) as context:
+            forms = forms_for_survey(self.survey, "testing", submission)
+        answer_queries = [q for q in context.captured_queries
+                          if 'FROM "crowdsourcing_answer"' in q["sql"]]
+        self.assertEquals(len(answer_queries), 1)
+        self.assertEquals([f.fields["answer"].initial for f in forms[:-1]],
+                          ["blue", "Springfield"])
+
+    def testResavingReplacesTheLocation(self):
+        _use_gazetteer(self)
+        submission = _submit(self.survey, color="blue", where="Springfield")
+        where = self.survey.questions.get(fieldname="where")
+        request = RequestFactory().post(
+            "/", {"%d_%d-answer" % (self.survey.id, where.id): "New York, NY"})
+        request.user = AnonymousUser()
+        survey = Survey.objects.get(pk=self.survey.pk)
+        form = [f for f in forms_for_survey(survey, request, submission)
+                if getattr(f, "question", None) == where][0]
+        self.assertTrue(form.is_valid())
+        form.save()
+        answers = submission.answer_set.filter(question=where)
+        self.assertEquals([a.text_answer for a in answers], ["New York, NY"])
+
+
+class AggregateResult2AxisTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = _make_survey()
+        for order, fieldname, option_type in (
+                (3, "age", OPTION_TYPE_CHOICES.INTEGER),
+                (4, "height", OPTION_TYPE_CHOICES.FLOAT)):
+            self.survey.questions.create(fieldname=fieldname,
+                                         question=fieldname.title(),
+                                         label=fieldname.title(),
+                                         order=order,
+                                         option_type=option_type)
+        _submit(self.survey, color="red", age=10, height=1.5)
+        _submit(self.survey, color="red", age=20, height=2.5)
+        _submit(self.survey, color="blue", age=30)
+        _submit(self.survey, is_public=False, color="blue", age=40)
+
+    def testAllYAxesInOneQuery(self):
+        questions = dict((q.fieldname, q)
+                         for q in self.survey.questions.all())
+        y_axes = [questions["age"], questions["height"]]
+        with CaptureQueriesContext(connection) as context:
+            result = AggregateResultSum(y_axes, questions["color"], {})
+        aggregates = [q for q in context.captured_queries
+                      if "GROUP BY" in q["sql"]]
+        self.assertEquals(len(aggregates), 1)
+        self.assertEquals(result.answer_values, [
+            dict(color="red", age=30, height=4.0),
+            dict(color="blue", age=30, height=0),
+            dict(color="green", age=0, height=0)])
+
+
+class SubmissionsExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        _override_settings(self, EXPORT_CHUNK_SIZE=2)
+        self.survey = _make_survey()
+        self.submissions = []
+        for i, color in enumerate(["red", "blue", "green"]):
+            submission = _submit(self.survey, color=color)
+            submission.submitted_at = datetime.datetime(2011, 1, i + 1)
+            submission.save()
+            self.submissions.append(submission)
+
+    def _export(self, format, **params):
+        params.setdefault("survey", self.survey.slug)
+        request = RequestFactory().get("/submissions/", params)
+        request.user = AnonymousUser()
+        response = views.submissions(request, format)
+        if response.streaming:
+            content = "".join(response.streaming_content)
+        else:
+            content = response.content
+        return response, content
+
+    def testStreamingMatchesBuiltResponse(self):
+        for format in ("json", "csv", "xml", "html"):
+            built = self._export(format)[1]
+            self.assertEquals(self._export(format, stream="1")[1], built)
+        exported = json.loads(self._export("json", stream="1")[1])
+        self.assertEquals([s["color"] for s in exported],
+                          ["green", "blue", "red"])
+
+    def testCsvColumnsComeFromTheSchema(self):
+        self.survey.questions.create(fieldname="secret",
+                                     question="Secret?",
+                                     label="Secret",
+                                     order=3,
+                                     answer_is_public=False,
+                                     option_type=OPTION_TYPE_CHOICES.CHAR)
+        rows = list(csv.reader(self._export("csv")[1].splitlines()))
+        # Nobody answered where, but it's a column anyway.
+        self.assertEquals(rows[0], ["color", "featured", "is_public",
+                                    "submitted_at", "survey", "user",
+                                    "where"])
+        self.assertEquals(rows[1], ["green", "0", "1", "2011-01-03",
+                                    "cached", "", ""])
+
+    def testGzippedNdjson(self):
+        response, content = self._export("ndjson.gz")
+        self.assertEquals(response["Content-Disposition"],
+                          'attachment; filename="submissions.ndjson.gz"')
+        ndjson = gzip.GzipFile(fileobj=StringIO(content)).read()
+        self.assertEquals(ndjson, self._export("ndjson")[1])
+        colors = [json.loads(line)["color"] for line in ndjson.splitlines()]
+        self.assertEquals(colors, ["green", "blue", "red"])
+
+    @unittest.skipUnless("parquet" in FORMAT_CHOICES, "needs pyarrow")
+    def testParquet(self):
+        import pyarrow.parquet
+        content = self._export("parquet")[1]
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(content))
+        self.assertEquals(table.column("color").to_pylist(),
+                          ["green", "blue", "red"])
+
+    def testColumnKinds(self):
+        columns = views._submission_columns(Submission.objects.all(),
+                                            False,
+                                            [self.survey])
+        self.assertEquals(dict(columns),
+                          dict(color="text",
+                               featured="boolean",
+                               is_public="boolean",
+                               submitted_at="datetime",
+                               survey="text",
+                               user="text",
+                               where="text"))
+
+
+class _FakeArrow(object):
+    """ Just enough of pyarrow and pyarrow.parquet for parquetsupport. Tables
+    are dicts of column lists, and the writer keeps the tables it gets. """
+    def __init__(self):
+        self.parquet = self.Table = self
+        self.tables = []
+
+    def string(self):
+        return "string"
+
+    def int64(self):
+        return "int64"
+
+    def float64(self):
+        return "float64"
+
+    def bool_(self):
+        return "bool"
+
+    def timestamp(self, unit):
+        return "timestamp"
+
+    def field(self, key, arrow_type):
+        return key
+
+    def schema(self, fields):
+        return fields
+
+    def array(self, values, type):
+        return values
+
+    def from_arrays(self, arrays, schema):
+        return dict(zip(schema, arrays))
+
+    def ParquetWriter(self, sink, schema):
+        arrow = self
+
+        class Writer(object):
+            def write_table(self, table):
+                arrow.tables.append(table)
+                sink.write("row group %d;" % len(arrow.tables))
+
+            def close(self):
+                sink.write("footer")
+        return Writer()
+
+
+class ParquetSupportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.arrow = _FakeArrow()
+        for name in ("pyarrow", "pyarrow.parquet"):
+            if name in sys.modules:
+                self.addCleanup(sys.modules.__setitem__, name,
+                                sys.modules[name])
+            else:
+                self.addCleanup(sys.modules.pop, name, None)
+            sys.modules[name] = self.arrow
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "parquetsupport.py")
+        self.parquetsupport = imp.load_source(
+            "crowdsourcing._fake_parquetsupport", path)
+        self.addCleanup(sys.modules.pop, "crowdsourcing._fake_parquetsupport",
+                        None)
+
+    def testRowGroupsAreChunksOfConvertedValues(self):
+        rows = [dict(color="red", age="1", height=1),
+                dict(color=2, age=2, height=None),
+                dict(color="blue", done=1)]
+        columns = [("color", "text"),
+                   ("age", "integer"),
+                   ("height", "float"),
+                   ("done", "boolean")]
+        content = self.parquetsupport.iter_parquet(rows, columns, 2)
+        self.assertEquals(list(content),
+                          ["row group 1;", "row group 2;", "footer"])
+        self.assertEquals(self.arrow.tables, [
+            dict(color=[u"red", u"2"],
+                 age=[1, 2],
+                 height=[1.0, None],
+                 done=[None, None]),
+            dict(color=[u"blue"], age=[None], height=[None], done=[True])])
+
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.survey = _make_survey()
+        self.other = _make_survey("other")
+        self.submissions = []
+        # Two submissions at the same time, so the ids have to break the tie.
+        for day, survey in ((1, self.survey), (2, self.other),
+                            (2, self.survey), (3, self.other),
+                            (4, self.survey)):
+            submission = _submit(survey, color="day %d" % day)
+            submission.submitted_at = datetime.datetime(2011, 1, day)
+            submission.save()
+            self.submissions.insert(0, submission)
+
+    def _request(self, **params):
+        request = RequestFactory().get("/submissions/", params)
+        request.user = AnonymousUser()
+        return request
+
+    def testApiLinksToTheNextPage(self):
+        seen = []
+        params = dict(survey=self.survey.slug, limit="2")
+        while True:
+            response = views.submissions(self._request(**params), "json")
+            seen.extend(s["color"] for s in json.loads(response.content))
+            if not response.has_header("Link"):
+                break
+            url = response["Link"][1:response["Link"].index(">")]
+            params = dict(parse_qsl(urlparse(url).query))
+        self.assertEquals(seen, ["day 4", "day 2", "day 1"])
+
+    def testPagesMergeSurveys(self):
+        querysets = [Submission.objects.filter(survey=self.survey),
+                     Submission.objects.filter(survey=self.other)]
+        page = views.KeysetPage(querysets, self._request(), 2)
+        self.assertEquals(page.object_list, self.submissions[:2])
+        self.assertFalse(page.has_previous())
+        after = dict(parse_qsl(page.next_query()))
+        page = views.KeysetPage(querysets, self._request(**after), 2)
+        self.assertEquals(page.object_list, self.submissions[2:4])
+        self.assertTrue(page.has_next())
+        before = dict(parse_qsl(page.previous_query()))
+        page = views.KeysetPage(querysets, self._request(**before), 2)
+        self.assertEquals(page.object_list, self.submissions[:2])
+        self.assertEquals(page.count(), 5)
+
+
+class MergeSubmissionsTestCase(TestCase):
+    def setUp(self):
+        self.survey = _make_survey()
+        self.other = _make_survey("other")
+        for day, survey in ((1, self.survey), (2, self.other),
+                            (3, self.survey), (4, self.other)):
+            submission = _submit(survey, color="red")
+            submission.submitted_at = datetime.datetime(2011, 1, day)
+            submission.save()
+        self.querysets = [Submission.objects.filter(survey=self.survey),
+                          Submission.objects.filter(survey=self.other)]
+
+    def _days(self, submissions):
+        return [s.submitted_at.day for s in submissions]
+
+    def testPagesNewestFirstAcrossSurveys(self):
+        merged = views.merge_submissions(self.querysets)
+        with self.assertNumQueries(2):
+            page = Paginator(merged, 2).page(2)
+            self.assertEquals(self._days(page.object_list), [2, 1])
+
+    def testKeepOrderChainsSurveys(self):
+        chain = views.merge_submissions(
+            [q.order_by("submitted_at") for q in self.querysets], True)
+        self.assertEquals(len(chain), 4)
+        self.assertEquals(self._days(chain[1:3]), [3, 2])
+        self.assertEquals(chain[3].submitted_at.day, 4)
+
+
+class BoundingBoxTestCase(unittest.TestCase):
+    def _in_box(self, miles, lat, lng, center=(39.8, -89.64)):
+        where, params = _bounding_box(center[0], center[1], miles)
+        lat_min, lat_max = params[:2]
+        if lat < lat_min or lat_max < lat:
+            return False
+        if 4 == len(params):
+            return params[2] <= lng <= params[3]
+        self.assertFalse("longitude" in where)
+        return True
+
+    def testBoxHoldsTheCircle(self):
+        # A degree of latitude is about 69 miles.
+        self.assertTrue(self._in_box(10, 39.8 + 9.9 / 69, -89.64))
+        self.assertTrue(self._in_box(10, 39.8, -89.64 - 9.9 / 53))
+        self.assertFalse(self._in_box(10, 39.8 + 11 / 69.0, -89.64))
+        self.assertFalse(self._in_box(10, 39.8, -89.64 + 11 / 53.0))
+
+    def testPolesAndTheDateLine(self):
+        self.assertTrue(self._in_box(100, 89.9, 90, center=(89.5, -90)))
+        self.assertTrue(self._in_box(100, 0, -179.5, center=(0, 179.5)))
+        self.assertEquals(_bounding_box(0, 0, 20000), ("", []))
+
+
+class GeocodedLocationTestCase(TestCase):
+    def setUp(self):
+        _use_gazetteer(self)
+
+    def testEachLocationIsGeocodedOnce(self):
+        self.assertEquals(GeocodedLocation.lookup_many(["Springfield",
+                                                        "Atlantis"]),
+                          {"Springfield": (39.8, -89.64),
+                           "Atlantis": (None, None)})
+        _override_settings(self, GEOCODER="crowdsourcing.tests.DownGeocoder")
+        geo._geocoder = None
+        self.assertEquals(GeocodedLocation.lookup("  SPRINGFIELD "),
+                          (39.8, -89.64))
+        self.assertEquals(GeocodedLocation.lookup("Atlantis"), (None, None))
+        self.assertEquals(GeocodedLocation.objects.count(), 2)
+
+    def testLookupWithoutGeocoding(self):
+        self.assertEquals(
+            GeocodedLocation.lookup_many(["Springfield"], geocode=False), {})
+        self.assertEquals(GeocodedLocation.objects.count(), 0)
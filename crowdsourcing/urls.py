@@ -8,6 +8,7 @@ from .views import (allowed_actions,
                     embeded_survey_report,
                     location_question_results,
                     location_question_map,
+                    location_question_tile,
                     questions,
                     submissions,
                     submission,
@@ -35,7 +36,7 @@ urlpatterns = patterns(
         {"format": "json"},
         name='submissions'),
 
-    url(r'^submissions/(?P<format>[a-z]+)/$',
+    url(r'^submissions/(?P<format>[a-z.]+)/$',
         submissions,
         name='submissions_by_format'),
 
@@ -53,6 +54,14 @@ urlpatterns = patterns(
         location_question_results,
         name="location_question_results"),
 
+    url(r'^location_question_tile/(?P<question_id>\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)/$',
+        location_question_tile,
+        kwargs={"survey_report_slug": ""}),
+
+    url(r'^location_question_tile/(?P<question_id>\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)/(?P<survey_report_slug>[-a-z0-9_]*)/$',
+        location_question_tile,
+        name="location_question_tile"),
+
     url(r'^location_question_map/(?P<question_id>\d+)/(?P<display_id>\d+)/$',
         location_question_map,
         name="location_question_map"),
@@ -1,8 +1,68 @@
 import itertools
 import re
 
+from django.core.signals import request_finished
+from django.db import connection
 from django.utils.importlib import import_module
 
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+try:
+    from django.db.transaction import on_commit
+
+    def run_commit_hooks(**kwargs):
+        pass
+except ImportError:
+    # Django < 1.9 doesn't have commit hooks, so crowdsourcing's own atomic
+    # runs them when its outermost block commits. Blocks that aren't ours,
+    # like the admin's or a cascading delete's, leave them for the next
+    # run_commit_hooks outside a transaction: the end of the request, or the
+    # next cache version read. Crowdsourcing only uses them to bump cache
+    # versions, which is harmless after a rollback, so they run then too.
+    _django_atomic = atomic
+
+    def _in_atomic_block():
+        return getattr(connection, "in_atomic_block", False)
+
+    def _commit_hooks():
+        if not hasattr(connection, "crowdsourcing_commit_hooks"):
+            connection.crowdsourcing_commit_hooks = []
+        return connection.crowdsourcing_commit_hooks
+
+    def run_commit_hooks(**kwargs):
+        if _in_atomic_block():
+            return
+        hooks = _commit_hooks()
+        while hooks:
+            hooks.pop(0)()
+
+    def on_commit(func):
+        """ Call func once the current transaction commits, or right away if
+        there isn't one. """
+        if _in_atomic_block():
+            _commit_hooks().append(func)
+        else:
+            func()
+
+    class atomic(object):
+        """ Django's atomic, as a context manager, that runs on_commit
+        callbacks when the outermost block exits. """
+        def __enter__(self):
+            self.block = _django_atomic()
+            self.block.__enter__()
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            try:
+                self.block.__exit__(exc_type, exc_value, traceback)
+            finally:
+                run_commit_hooks()
+
+    request_finished.connect(run_commit_hooks)
+
 
 def get_function(path):
     """ This used to use import_module, but certain Django-isms such as object
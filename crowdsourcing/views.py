@@ -1,35 +1,52 @@
 from __future__ import absolute_import
 
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import md5
 import httplib
 from itertools import count
 import logging
+import math
+import operator
 import smtplib
+import time
+from urlparse import urlparse
+import zlib
 from xml.dom.minidom import Document
+from xml.sax.saxutils import escape as xml_escape
 #from Tools.Scripts.classfix import rep
 import django.views.generic
 
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import FieldError
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.core.urlresolvers import reverse, NoReverseMatch
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.db.models import Avg, Count, Q
+from django.http import (HttpResponse, HttpResponseRedirect, Http404,
+                         HttpResponseNotModified, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext as _rc
 from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.html import escape
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
 
-from .forms import forms_for_survey
+from .cacheutils import get_version
+from .forms import forms_for_survey, option_value
+from .geo import QUADKEY_ZOOM, tile_quadkey
 from .models import (
     Answer,
     BALLOT_STUFFING_FIELDS,
     FORMAT_CHOICES,
     OPTION_TYPE_CHOICES,
+    PendingSubmission,
+    PendingSurveyEmail,
     Question,
     SURVEY_DISPLAY_TYPE_CHOICES,
     Submission,
@@ -38,21 +55,72 @@ from .models import (
     SurveyReportDisplay,
     extra_from_filters,
     get_all_answers,
+    iter_parquet,
     #get_filters
     )
 from .jsonutils import dump, dumps, datetime_to_string
 
-from .util import ChoiceEnum, get_function, get_session, get_user
+from .util import ChoiceEnum, atomic, get_function, get_session, get_user
 from . import settings as crowdsourcing_settings
 
 
 def allow_origin_sites():
-    database_sites = []
-    sites = Site.objects.all()
-    for protocol in ["http", "https"]:
-        database_sites += ["%s://%s" % (protocol, s.domain) for s in sites]
-    config_sites = getattr(settings, "ADDITIONAL_CORS_SITES", [])
-    return list(set(database_sites + config_sites))
+    """ Every Site and ADDITIONAL_CORS_SITES entry, with a scheme. Entries
+    without one are allowed over both http and https. """
+    domains = [s.domain for s in Site.objects.all()]
+    config_sites = []
+    for site in getattr(settings, "ADDITIONAL_CORS_SITES", []):
+        if "://" in site:
+            config_sites.append(site)
+        else:
+            domains.append(site.strip("/"))
+    sites = ["%s://%s" % (protocol, domain)
+             for protocol in ["http", "https"] for domain in domains]
+    return list(set(sites + config_sites))
+
+
+def _origin_keys(url):
+    """ The scheme and host the url is on, with and without the port. """
+    parsed = urlparse(url)
+    scheme, netloc = parsed.scheme.lower(), parsed.netloc.lower()
+    keys = [(scheme, netloc)]
+    host = parsed.hostname or ""
+    if host != netloc:
+        keys.append((scheme, host))
+    return keys
+
+
+class OriginMatcher(object):
+    """ allow_origin_sites() grouped by scheme and host, so that checking an
+    origin only looks at the sites on its host. """
+    def __init__(self, sites, version=None):
+        self.sites = sites
+        self.version = version
+        self.by_key = {}
+        for site in sites:
+            self.by_key.setdefault(_origin_keys(site)[0], []).append(site)
+
+    def allowed(self, origin):
+        if not origin:
+            return self.sites
+        allowed = []
+        for key in _origin_keys(origin):
+            allowed += [a for a in self.by_key.get(key, [])
+                        if origin.find(a) >= 0]
+        return allowed
+
+
+_origin_matcher = None
+
+
+def get_origin_matcher():
+    """ Site changes bump the cors_sites version, which is the only thing
+    a response checks before reusing this process's matcher. """
+    global _origin_matcher
+    version = get_version("cors_sites")
+    if _origin_matcher is None or _origin_matcher.version != version:
+        _origin_matcher = OriginMatcher(allow_origin_sites(), version)
+    return _origin_matcher
 
 
 def api_response(request, data, callback=None, format='json'):
@@ -71,12 +139,13 @@ def api_response(request, data, callback=None, format='json'):
     else:
         response = HttpResponse(mimetype='application/json')
         dump(data, response)
+    return _allow_origin(request, response)
+
 
+def _allow_origin(request, response):
     origin = request.META.get('HTTP_REFERER', '') or \
              request.META.get('HTTP_ORIGIN', '')
-    allowed = allow_origin_sites()
-    if origin:
-        allowed = [a for a in allowed if origin.find(a) >= 0]
+    allowed = get_origin_matcher().allowed(origin)
     response["Access-Control-Allow-Origin"] = " ".join(allowed)
     response['Access-Control-Allow-Methods'] = \
         'POST, GET, OPTIONS, HEAD, PUT, DELETE'
@@ -102,9 +171,86 @@ def api_response_decorator(format='json'):
     return _api_response_decorator
 
 
+def conditional_get(get_versions, public=True, cors=True):
+    """ Let clients and CDNs cache a read-only view while
+    CROWDSOURCING_HTTP_CACHE_TIMEOUT is on. get_versions takes the view's
+    arguments and returns the times that everything the response depends on
+    last changed, or None if the response can't be cached. The ETag comes
+    from those and the full url, and Last-Modified is the latest of them. A
+    response that renders a csrf token doesn't get cached. """
+    def _conditional_get(the_func):
+        def _decorated(request, *args, **kwargs):
+            timeout = crowdsourcing_settings.HTTP_CACHE_TIMEOUT
+            versions = None
+            if all((timeout,
+                    request.method.upper() in ("GET", "HEAD"),
+                    not get_user(request).is_staff)):
+                versions = get_versions(request, *args, **kwargs)
+            if not versions:
+                return the_func(request, *args, **kwargs)
+            key = repr([request.get_full_path()] + list(versions))
+            etag = md5(key).hexdigest()
+            # HTTP dates are whole seconds. Never claim a Last-Modified later
+            # than now, so any bump after this response is later than it.
+            latest = max(versions)
+            last_modified = int(min(math.ceil(latest),
+                                    math.floor(time.time())))
+            if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+            if if_none_match:
+                not_modified = etag in parse_etags(if_none_match)
+            else:
+                since = parse_http_date_safe(
+                    request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+                not_modified = since is not None and latest <= since
+            if not_modified:
+                response = HttpResponseNotModified()
+                if cors:
+                    _allow_origin(request, response)
+            else:
+                response = the_func(request, *args, **kwargs)
+                if response.status_code != httplib.OK:
+                    return response
+                if request.META.get("CSRF_COOKIE_USED"):
+                    return response
+            response["ETag"] = quote_etag(etag)
+            response["Last-Modified"] = http_date(last_modified)
+            visibility = "public" if public else "private"
+            patch_cache_control(response, max_age=timeout, **{visibility: True})
+            if cors:
+                # Access-Control-Allow-Origin depends on the origin.
+                patch_vary_headers(response, ["Origin"])
+            return response
+        return _decorated
+    return _conditional_get
+
+
+def _survey_versions(survey, report_slug=""):
+    """ When the survey's questions, its public submissions, and the report
+    last changed, along with its start and end if they've passed, since
+    they open and close it. is_open goes by the start date when there's no
+    end. """
+    now = datetime.now()
+    versions = [survey.get_schema_version(), survey.get_data_version()]
+    starts_on = survey.starts_at.replace(hour=0, minute=0, second=0,
+                                         microsecond=0)
+    for at in (starts_on, survey.starts_at, survey.ends_at):
+        if at and at <= now:
+            versions.append(time.mktime(at.timetuple()))
+    if report_slug:
+        reports = survey.surveyreport_set.filter(slug=report_slug)
+        versions += [get_version("survey_report_%d" % pk)
+                     for pk in reports.values_list("pk", flat=True)]
+    return versions
+
+
 def _user_entered_survey(request, survey):
     if not get_user(request).is_authenticated():
         return False
+    if crowdsourcing_settings.ASYNC_SUBMISSIONS:
+        pending = PendingSubmission.objects.filter(survey=survey,
+                                                   user=get_user(request))
+        if pending.exists():
+            return True
     return bool(survey.submissions_for(
         get_user(request),
         get_session(request).session_key.lower()).count())
@@ -177,22 +323,82 @@ def _submit_valid_forms(forms, request, survey):
     submission.is_public = not survey.moderate_submissions
     if get_user(request).is_authenticated():
         submission.user = get_user(request)
-    submission.save()
+    answers = []
+    replace_questions = []
     for form in forms[0:-1]:
         answer = form.save(commit=False)
         if isinstance(answer, (list, tuple)):
-            for a in answer:
-                a.submission = submission
-                a.save()
+            answers.extend(answer)
         elif answer:
-                answer.submission = submission
-                answer.save()
+            answers.append(answer)
+        if form.replaces_answers:
+            replace_questions.append(form.question)
+    host = request.META.get("HTTP_HOST", "")
+    if _can_queue(submission, answers):
+        PendingSubmission.from_submission(submission, answers, host).save()
+        return True
+    submission.save_with_answers(answers, replace_questions)
     if survey.email:
-        _send_survey_email(request, survey, submission)
+        _send_survey_email(host, survey, submission)
     return True
 
 
-def _url_for_edit(request, obj):
+def _can_queue(submission, answers):
+    """ Uploaded photos can't wait in the queue. Neither can submissions to
+    surveys that let users change their answers, because the next visit has
+    to find the submission to edit it. """
+    photo = OPTION_TYPE_CHOICES.PHOTO
+    return all((
+        crowdsourcing_settings.ASYNC_SUBMISSIONS,
+        not submission.survey.allow_response_change,
+        not any(a.question.option_type == photo for a in answers)))
+
+
+def ingest_pending_submissions(limit=None):
+    """ Write a batch of the submissions that _submit_valid_forms queued
+    when CROWDSOURCING_ASYNC_SUBMISSIONS is on. Returns how many it claimed.
+    Workers claim the rows they write, so any number can run at once. A row
+    that can't be written is marked failed and left in the queue without
+    holding up the rest of the batch. """
+    limit = limit or crowdsourcing_settings.INGEST_BATCH_SIZE
+    queued = PendingSubmission.objects.filter(failed_at__isnull=True)
+    pending = PendingSubmission.claim(limit, queued.select_related("survey"))
+    # Share survey instances so each survey loads its questions once.
+    surveys = {}
+    for p in pending:
+        p.survey = surveys.setdefault(p.survey_id, p.survey)
+    written = []
+    with atomic():
+        try:
+            with atomic():
+                written = [(p, p.to_submission()) for p in pending]
+                Submission.save_all_with_answers([w for p, w in written])
+        except Exception:
+            # Something in the batch is bad. Write the rows one at a time
+            # so that only the bad ones fail.
+            written = []
+            for p in pending:
+                try:
+                    with atomic():
+                        submission = p.to_submission()
+                        Submission.save_all_with_answers([submission])
+                except Exception as ex:
+                    logging.exception("Error writing pending submission %d: "
+                                      "%s" % (p.pk, str(ex)))
+                    PendingSubmission.objects.filter(pk=p.pk).update(
+                        failed_at=datetime.now(), error=repr(ex))
+                else:
+                    written.append((p, submission))
+        ids = [p.pk for p, w in written]
+        PendingSubmission.objects.filter(pk__in=ids).delete()
+    for p, (submission, answers) in written:
+        submission.answers_committed(answers)
+        if submission.survey.email:
+            _send_survey_email(p.host, submission.survey, submission)
+    return len(pending)
+
+
+def _url_for_edit(host, obj):
     view_args = (obj._meta.app_label, obj._meta.module_name,)
     try:
         edit_url = reverse("admin:%s_%s_change" % view_args, args=(obj.id,))
@@ -202,13 +408,94 @@ def _url_for_edit(request, obj):
         edit_url = "/admin/%s/%s/%d/" % (view_args + (obj.id,))
     admin_url = crowdsourcing_settings.SURVEY_ADMIN_SITE
     if not admin_url:
-        admin_url = "http://" + request.META["HTTP_HOST"]
+        admin_url = "http://" + host
     elif len(admin_url) < 4 or admin_url[:4].lower() != "http":
         admin_url = "http://" + admin_url
     return admin_url + edit_url
 
 
-def _send_survey_email(request, survey, submission):
+def _send_survey_email(http_host, survey, submission):
+    if not crowdsourcing_settings.SYNCHRONOUS_SURVEY_EMAIL:
+        PendingSurveyEmail.objects.create(survey=survey,
+                                          submission=submission,
+                                          host=http_host)
+        return
+    _send_messages(_survey_email_messages(http_host, survey, [submission]))
+
+
+def send_pending_survey_emails():
+    """ Send the notification emails queued when
+    CROWDSOURCING_SYNCHRONOUS_SURVEY_EMAIL is off, all over one SMTP
+    connection. Surveys with an email digest size get one email per that many
+    submissions. Surveys with an email digest window get one email once the
+    oldest submission is old enough, and that also sends a digest smaller
+    than the digest size. Emails stay queued until they're sent. Returns how
+    many submissions it sent notifications for. """
+    pending = PendingSurveyEmail.claim(
+        None, PendingSurveyEmail.objects.select_related("survey", "submission"))
+    by_survey = {}
+    for p in pending:
+        by_survey.setdefault(p.survey_id, []).append(p)
+    groups = []
+    for survey_pending in by_survey.values():
+        groups.extend(_survey_email_groups(survey_pending))
+    sent = []
+    connection = get_connection()
+    try:
+        connection.open()
+        for group in groups:
+            survey = group[0].survey
+            submissions = [p.submission for p in group]
+            connection.send_messages(
+                _survey_email_messages(group[-1].host, survey, submissions))
+            PendingSurveyEmail.objects.filter(
+                pk__in=[p.pk for p in group]).delete()
+            sent.extend(group)
+    except Exception as ex:
+        logging.exception("Error sending survey emails: %s" % str(ex))
+    finally:
+        connection.close()
+        # Whatever didn't go out goes back in the queue.
+        PendingSurveyEmail.objects.filter(
+            pk__in=[p.pk for p in pending]).update(claimed_by="",
+                                                   claimed_at=None)
+    return len(sent)
+
+
+def _survey_email_groups(survey_pending):
+    """ Split one survey's queued emails, oldest first, into the emails due
+    now. """
+    survey = survey_pending[0].survey
+    size = survey.email_digest_size
+    minutes = survey.email_digest_minutes
+    if not (size or minutes):
+        return [[p] for p in survey_pending]
+    step = size or len(survey_pending)
+    groups = [survey_pending[i:i + step]
+              for i in range(0, len(survey_pending), step)]
+    last = groups[-1]
+    full = size and len(last) == size
+    window = minutes and timedelta(minutes=minutes)
+    expired = window and datetime.now() - last[0].created_at >= window
+    if not (full or expired):
+        groups.pop()
+    return groups
+
+
+def _send_messages(messages):
+    if not messages:
+        return
+    try:
+        get_connection().send_messages(messages)
+    except smtplib.SMTPException as ex:
+        logging.exception("SMTP error sending email: %s" % str(ex))
+    except Exception as ex:
+        logging.exception("Unexpected error sending email: %s" % str(ex))
+
+
+def _survey_email_messages(http_host, survey, submissions):
+    """ Build the notification emails for one or more submissions to survey.
+    More than one submission makes a digest. """
     recipients = [a.strip() for a in survey.email.split(",")]
     if crowdsourcing_settings.ALL_STAFF_EMAIL_NOTIFICATION:
         staff = recipients
@@ -218,50 +505,62 @@ def _send_survey_email(request, survey, submission):
         staff = list(set([u.email for u in staff_users]))
         public = [e for e in recipients if not e in staff]
 
-    def _send_msg(subject, parts, emails):
+    def _msg(subject, parts, emails):
         html_email = "<br/>\n".join(parts)
         sender = crowdsourcing_settings.SURVEY_EMAIL_FROM
         email_msg = EmailMultiAlternatives(subject, html_email, sender, emails)
         email_msg.attach_alternative(html_email, 'text/html')
-        try:
-            email_msg.send()
-        except smtplib.SMTPException as ex:
-            logging.exception("SMTP error sending email: %s" % str(ex))
-        except Exception as ex:
-            logging.exception("Unexpected error sending email: %s" % str(ex))
-
-    answs = Answer.objects.filter(submission=submission)
-    host = "http://" + request.META["HTTP_HOST"]
+        return email_msg
+
+    answer_lookup = get_all_answers(submissions,
+                                    include_private_questions=True)
+    host = "http://" + http_host
     report_url = host + _survey_report_url(survey)
+    is_digest = len(submissions) > 1
+    messages = []
     if staff:
-        links = [(_url_for_edit(request, submission), "Edit Submission"),
-                 (_url_for_edit(request, survey), "Edit Survey"),]
+        survey_links = [(_url_for_edit(http_host, survey), "Edit Survey")]
         if survey.can_have_public_submissions():
-            u = report_url
-            links.append((u, "View Survey",))
-        parts = ["<a href=\"%s\">%s</a>" % link for link in links]
-        lines = ["%s: %s" % (a.question.label, escape(a.value),) for a in answs]
-        parts.extend(lines)
-        _send_msg(survey.title, parts, staff)
+            survey_links.append((report_url, "View Survey",))
+        parts = []
+        if is_digest:
+            parts.extend(["<a href=\"%s\">%s</a>" % l for l in survey_links])
+        for submission in submissions:
+            links = [(_url_for_edit(http_host, submission), "Edit Submission")]
+            if not is_digest:
+                links.extend(survey_links)
+            parts.extend(["<a href=\"%s\">%s</a>" % link for link in links])
+            answs = answer_lookup.get(submission.pk, [])
+            parts.extend(["%s: %s" % (a.question.label, escape(a.value),)
+                          for a in answs])
+        subject = survey.title
+        if is_digest:
+            subject = "%s (%d new submissions)" % (subject, len(submissions))
+        messages.append(_msg(subject, parts, staff))
     if public:
         subject = []
         body = []
         OTC = OPTION_TYPE_CHOICES
-        for ans in answs:
-            if ans.value:
-                opt_type = ans.question.option_type
-                if any([opt_type in (OTC.SELECT, OTC.LOCATION),
-                        ans.question.question.lower().find("title") >= 0]):
-                    subject.append(ans.value)
-                elif opt_type in (OTC.PHOTO):
-                    image_src = host + ans.image_answer.thumbnail.absolute_url
-                    body.append("<img src='%s' />" % (image_src))
-                else:
-                    body.append(ans.value)
+        for submission in submissions:
+            for ans in answer_lookup.get(submission.pk, []):
+                if ans.value:
+                    opt_type = ans.question.option_type
+                    if any([opt_type in (OTC.SELECT, OTC.LOCATION),
+                            ans.question.question.lower().find("title") >= 0]):
+                        subject.append(ans.value)
+                    elif opt_type == OTC.PHOTO:
+                        thumbnail = ans.image_answer.thumbnail.absolute_url
+                        body.append("<img src='%s' />" % (host + thumbnail))
+                    else:
+                        body.append(escape(ans.value))
         body.append("<a href='%s'>See the survey</a>" % report_url)
-        subject = ". ".join(subject) or survey.title
-        html_email = "<br/>\n".join(body)
-        _send_msg(subject, body, public)
+        if is_digest:
+            subject = "%s (%d new submissions)" % (survey.title,
+                                                   len(submissions))
+        else:
+            subject = ". ".join(subject) or survey.title
+        messages.append(_msg(subject, body, public))
+    return messages
 
 
 def _survey_show_form(request, survey, forms):
@@ -357,6 +656,14 @@ def _survey_report_url(survey):
                        kwargs={'slug': survey.slug})
 
 
+def _allowed_actions_versions(request, slug):
+    # Whether a logged in user may enter depends on their own submissions.
+    if get_user(request).is_authenticated():
+        return None
+    return _survey_versions(_get_survey_or_404(slug, request))
+
+
+@conditional_get(_allowed_actions_versions, public=False)
 @api_response_decorator()
 def allowed_actions(request, slug):
     survey = _get_survey_or_404(slug, request)
@@ -368,6 +675,11 @@ def allowed_actions(request, slug):
         "need_login": survey.require_login and not authenticated}
 
 
+def _questions_versions(request, slug):
+    return _survey_versions(_get_survey_or_404(slug, request))
+
+
+@conditional_get(_questions_versions)
 @api_response_decorator()
 def questions(request, slug):
     return _get_survey_or_404(slug, request).to_jsondata()
@@ -387,6 +699,14 @@ def submissions(request, format):
         For example, 2010-04-05T13:02:03
     featured - A blank value, 'f', 'false', 0, 'n', and 'no' all mean ignore
         the featured flag. Everything else means display only featured.
+    limit - Only return the latest this many submissions. If there could be
+        more, the response has a Link header to the next batch.
+    after - Only return submissions older than this cursor. Follow the Link
+        header rather than building cursors yourself.
+    stream - Any non-blank value streams the results out in chunks as they're
+        read from the database rather than building the whole response in
+        memory first. The ndjson, ndjson.gz, and parquet formats always
+        stream.
     You can also use filters in the survey report sense. Rather than document
     exactly what parameters you would pass, follow these steps to figure it
     out:
@@ -410,6 +730,8 @@ def submissions(request, format):
     results = results.select_related("survey", "user")
     get = request.GET.copy()
     limit = int(get.pop("limit", [0])[0])
+    after = get.pop("after", [""])[0]
+    stream = get.pop("stream", [""])[0] or format in _STREAM_ONLY_FORMATS
     keys = get.keys()
     basic_filters = (
         'survey',
@@ -483,12 +805,39 @@ def submissions(request, format):
     if not is_staff:
         if survey_slug:
             if not get_survey().can_have_public_submissions():
-                results = []
+                results = results.none()
+        else:
+            public_surveys = [s.pk for s in Survey.objects.all()
+                              if s.can_have_public_submissions()]
+            results = results.filter(survey__in=public_surveys)
+    results = results.order_by(*SUBMISSION_ORDER)
+    if after:
+        try:
+            results = keyset_filter(results, after)
+        except ValueError:
+            return HttpResponse("Invalid after: %s" % escape(after))
+    columns = keys = None
+    if format in ('csv', 'html', 'parquet'):
+        if survey_slug:
+            surveys = [get_survey()]
         else:
-            rs = [r for r in results if r.survey.can_have_public_submissions()]
-            results = rs
+            surveys = Survey.objects.filter(
+                pk__in=results.values("survey_id").order_by().distinct())
+        columns = _submission_columns(results, is_staff, surveys)
+        keys = [key for key, kind in columns]
+    if stream:
+        response = _stream_submissions(
+            results, format, is_staff, limit, columns)
+        if limit:
+            last = results[limit - 1:limit]
+            if last:
+                _add_next_link(response, request, last[0])
+        return response
+    last = None
     if limit:
-        results = results[:limit]
+        results = list(results[:limit])
+        if len(results) == limit:
+            last = results[-1]
     answer_lookup = get_all_answers(results,
                                     include_private_questions=is_staff)
     result_data = []
@@ -500,20 +849,12 @@ def submissions(request, format):
         data.update(data["data"])
         data.pop("data")
 
-    def get_keys():
-        key_lookup = {}
-        for data in result_data:
-            for key in data.keys():
-                key_lookup[key] = True
-        return sorted(key_lookup.keys())
-
     if format == 'json':
         response = HttpResponse(mimetype='application/json')
         dump(result_data, response)
     elif format == 'csv':
         response = HttpResponse(mimetype='text/csv')
         writer = csv.writer(response)
-        keys = get_keys()
         writer.writerow(keys)
         for data in result_data:
             row = []
@@ -534,7 +875,6 @@ def submissions(request, format):
                     cell.appendChild(doc.createTextNode(u"%s" % value))
         response = HttpResponse(doc.toxml(), mimetype='text/xml')
     elif format == 'html': # mostly for debugging.
-        keys = get_keys()
         results = [
             "<html><body><table>",
             "<tr>%s</tr>" % "".join(["<th>%s</th>" % k for k in keys])]
@@ -546,9 +886,201 @@ def submissions(request, format):
         response = HttpResponse("\n".join(results))
     else:
         return HttpResponse("Unsure how to handle %s format" % format)
+    if last:
+        _add_next_link(response, request, last)
     return response
 
 
+def _add_next_link(response, request, last_submission):
+    get = request.GET.copy()
+    get["after"] = encode_cursor(last_submission)
+    url = request.build_absolute_uri("?" + get.urlencode())
+    response["Link"] = '<%s>; rel="next"' % url
+
+
+_STREAM_ONLY_FORMATS = ('ndjson', 'ndjson.gz', 'parquet')
+
+
+def _stream_submissions(results, format, is_staff, limit, columns):
+    rows = _iter_submission_data(results, is_staff, limit)
+    keys = columns and [key for key, kind in columns]
+    attachment = None
+    if format == 'json':
+        content = _iter_json(rows)
+        mimetype = 'application/json'
+    elif format == 'ndjson':
+        content = (dumps(data) + "\n" for data in rows)
+        mimetype = 'application/x-ndjson'
+    elif format == 'ndjson.gz':
+        content = _iter_gzip(dumps(data) + "\n" for data in rows)
+        mimetype = 'application/gzip'
+        attachment = 'submissions.ndjson.gz'
+    elif format == 'parquet':
+        chunk_size = crowdsourcing_settings.EXPORT_CHUNK_SIZE
+        content = iter_parquet(rows, columns, chunk_size)
+        mimetype = 'application/octet-stream'
+        attachment = 'submissions.parquet'
+    elif format == 'csv':
+        content = _iter_csv(rows, keys)
+        mimetype = 'text/csv'
+    elif format == 'xml':
+        content = _iter_xml(rows)
+        mimetype = 'text/xml'
+    elif format == 'html':
+        content = _iter_html(rows, keys)
+        mimetype = 'text/html'
+    else:
+        return HttpResponse("Unsure how to handle %s format" % format)
+    response = StreamingHttpResponse(content, content_type=mimetype)
+    if attachment:
+        response['Content-Disposition'] = (
+            'attachment; filename="%s"' % attachment)
+    return response
+
+
+def _iter_submission_data(results, is_staff, limit=0):
+    """ Yield the flattened to_jsondata of each submission, newest first.
+    Only one chunk of submissions and their answers is in memory at a time. """
+    chunk_size = crowdsourcing_settings.EXPORT_CHUNK_SIZE
+    results = results.order_by(*SUBMISSION_ORDER)
+    cursor = None
+    remaining = limit
+    while True:
+        chunk = results
+        if cursor is not None:
+            chunk = keyset_filter(chunk, cursor)
+        size = min(chunk_size, remaining) if limit else chunk_size
+        chunk = list(chunk[:size])
+        if not chunk:
+            return
+        answer_lookup = get_all_answers(chunk,
+                                        include_private_questions=is_staff)
+        for r in chunk:
+            data = r.to_jsondata(answer_lookup,
+                                 include_private_questions=is_staff)
+            data.update(data.pop("data"))
+            yield data
+        cursor = encode_cursor(chunk[-1])
+        remaining -= len(chunk)
+        if len(chunk) < size or (limit and remaining <= 0):
+            return
+
+
+# Question.value_column -> the kind of export column it makes.
+_COLUMN_KINDS = {
+    "text_answer": "text",
+    "integer_answer": "integer",
+    "float_answer": "float",
+    "boolean_answer": "boolean",
+    "image_answer": "text"}
+
+
+def _submission_columns(results, is_staff, surveys):
+    """ (key, kind) pairs for the columns of csv, html, and parquet exports.
+    They come from the surveys' questions, so we know them before reading any
+    submissions and they stay the same from one export to the next. kind is
+    text, integer, float, boolean, or datetime. """
+    kinds = dict(survey="text",
+                 submitted_at="datetime",
+                 featured="boolean",
+                 is_public="boolean",
+                 user="text")
+    if is_staff:
+        kinds.update((key, "text") for key in BALLOT_STUFFING_FIELDS)
+
+    def add(key, kind):
+        # The same fieldname in two surveys might not hold the same type.
+        if kinds.setdefault(key, kind) != kind:
+            kinds[key] = "text"
+    OTC = OPTION_TYPE_CHOICES
+    write_ins = []
+    for survey in surveys:
+        if is_staff:
+            fields = survey.get_fields()
+        else:
+            fields = survey.get_public_fields()
+        for question in fields:
+            if OTC.BOOL_LIST == question.option_type:
+                # Each checked option gets its own key.
+                options = [option_value(o) for o in question.parsed_options]
+                for option in options:
+                    add(option, "boolean")
+                if question.allow_arbitrary:
+                    write_ins.append((question, options))
+            else:
+                add(question.fieldname, _COLUMN_KINDS[question.value_column])
+    # Write-in answers to checkbox questions get their own keys too.
+    for question, options in write_ins:
+        answers = Answer.objects.filter(
+            question=question,
+            submission__in=results.values("id"))
+        answers = answers.exclude(text_answer__in=options)
+        answers = answers.values_list("text_answer", flat=True)
+        for write_in in answers.order_by().distinct():
+            add(write_in, "boolean")
+    return sorted(kinds.items())
+
+
+class _Echo(object):
+    """ csv.writer wants something to write to. This hands back what it
+    would have written instead. """
+    def write(self, value):
+        return value
+
+
+def _iter_csv(rows, keys):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(keys)
+    for data in rows:
+        row = []
+        for k in keys:
+            row.append((u"%s" % _encode(data.get(k, ""))).encode("utf-8"))
+        yield writer.writerow(row)
+
+
+def _iter_gzip(content):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for data in content:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _iter_json(rows):
+    yield "["
+    separator = ""
+    for data in rows:
+        yield separator + dumps(data)
+        separator = ", "
+    yield "]"
+
+
+def _iter_xml(rows):
+    # Matches what submissions builds with minidom, one submission at a time.
+    yield '<?xml version="1.0" ?><submissions>'
+    entities = {'"': "&quot;"}
+    for data in rows:
+        cells = []
+        for key, value in data.items():
+            if value:
+                text = xml_escape(u"%s" % value, entities)
+                cells.append(u"<%s>%s</%s>" % (key, text, key))
+        xml = u"<submission>%s</submission>" % u"".join(cells)
+        yield xml.encode("utf-8")
+    yield "</submissions>"
+
+
+def _iter_html(rows, keys):
+    yield "<html><body><table>\n"
+    yield "<tr>%s</tr>\n" % "".join(["<th>%s</th>" % k for k in keys])
+    for data in rows:
+        cell = u"<td>%s</td>"
+        cells = [cell % _encode(data.get(key, "")) for key in keys]
+        yield (u"<tr>%s</tr>\n" % u"".join(cells)).encode("utf-8")
+    yield "</table></body></html>"
+
+
 def _encode(possible):
     if possible is True:
         return 1
@@ -624,6 +1156,24 @@ class SurveyReportView(django.views.generic.TemplateView):
         survey_pairs = [(survey.slug, survey) for survey in report.survey.all()]
         return dict(survey_pairs)
 
+    def get(self, request, *args, **kwargs):
+        sup = super(SurveyReportView, self)
+        if (not crowdsourcing_settings.REPORT_CACHE_TIMEOUT or
+            get_user(request).is_authenticated()):
+            # _cached_report would only render it, so skip the versions.
+            return sup.get(request, *args, **kwargs)
+        report_obj = self._get_report()
+        surveys = self._get_surveys(report_obj).values()
+        key = _report_cache_key(request,
+                                "report",
+                                report_obj.slug,
+                                self.kwargs.get('page', 1))
+        versions = _report_versions(report_obj, surveys)
+
+        def render():
+            return sup.get(request, *args, **kwargs).rendered_content
+        return HttpResponse(_cached_report(request, key, versions, render))
+
     def get_context_data(self, **kwargs):
         user_is_staff = self.request.user.is_staff
         report_obj = self._get_report()
@@ -645,8 +1195,17 @@ class SurveyReportView(django.views.generic.TemplateView):
         else:
             context['submissions'] = self._get_submissions(surveys, not user_is_staff, report_obj)
         context['fields'] = self._get_fields(surveys,not user_is_staff)
-        all_submissions = reduce(lambda a,b:a+b, context['submissions'].values())
-        paginator, page_obj = paginate_or_404(all_submissions, page)
+        # PRE_REPORT may have sorted each survey's submissions its own way.
+        keep_order = bool(crowdsourcing_settings.PRE_REPORT)
+        all_submissions = merge_submissions(context['submissions'].values(),
+                                            keep_order)
+        if _use_keyset_pagination(report_obj):
+            paginator = None
+            page_obj = KeysetPage([all_submissions], self.request)
+            pages_to_link = []
+        else:
+            paginator, page_obj = paginate_or_404(all_submissions, page)
+            pages_to_link = pages_to_link_from_paginator(page, paginator)
         context['paginator'] = paginator
         context['page_obj'] = page_obj
 
@@ -654,7 +1213,7 @@ class SurveyReportView(django.views.generic.TemplateView):
             page_obj.object_list,
             include_private_questions=user_is_staff)
 
-        context['pages_to_link'] = pages_to_link_from_paginator(page, paginator)
+        context['pages_to_link'] = pages_to_link
 
         context['display_individual_results'] = all([
             report_obj.display_individual_results,
@@ -713,8 +1272,14 @@ class SurveyReportView(django.views.generic.TemplateView):
         return dict(pairs)
 
 
+def _embeded_survey_report_versions(request, slug, report=''):
+    # Reports render with a RequestContext, so only anonymous users share.
+    if get_user(request).is_authenticated():
+        return None
+    return _survey_versions(_get_survey_or_404(slug, request), report)
 
 
+@conditional_get(_embeded_survey_report_versions)
 @api_response_decorator(format='html')
 def embeded_survey_report(request, slug, report=''):
     templates = ['crowdsourcing/embeded_survey_report_%s.html' % slug,
@@ -749,6 +1314,22 @@ def _survey_report(request, slug, report, page, templates):
     else:
         report_obj = _default_report(survey, is_staff)
 
+    key = _report_cache_key(request, "survey", slug, report, page)
+    versions = _report_versions(report_obj, [survey])
+
+    def render():
+        return _render_survey_report(
+            request, survey, report_obj, page, templates, is_public, is_staff)
+    return _cached_report(request, key, versions, render)
+
+
+def _render_survey_report(request,
+                          survey,
+                          report_obj,
+                          page,
+                          templates,
+                          is_public,
+                          is_staff):
     if is_staff:
         archive_fields = list(survey.get_archive_fields())
         submissions = survey.submission_set.all()
@@ -778,14 +1359,18 @@ def _survey_report(request, slug, report, page, templates):
             submissions = submissions.filter(featured=True)
         if report_obj.limit_results_to:
             submissions = submissions[:report_obj.limit_results_to]
-    paginator, page_obj = paginate_or_404(submissions, page)
+    if _use_keyset_pagination(report_obj):
+        paginator = None
+        page_obj = KeysetPage([submissions], request)
+        pages_to_link = []
+    else:
+        paginator, page_obj = paginate_or_404(submissions, page)
+        pages_to_link = pages_to_link_from_paginator(page, paginator)
 
     page_answers = get_all_answers(
         page_obj.object_list,
         include_private_questions=is_staff)
 
-    pages_to_link = pages_to_link_from_paginator(page, paginator)
-
     display_individual_results = all([
         report_obj.display_individual_results,
         archive_fields or (is_staff and fields)])
@@ -808,6 +1393,63 @@ def _survey_report(request, slug, report, page, templates):
     return render_to_string(templates, context, _rc(request))
 
 
+# How long one process gets to re-render a stale report before another may
+# try.
+_REPORT_RENDER_LOCK_TIMEOUT = 60
+
+
+def _report_cache_key(request, *parts):
+    # JSONP callbacks and jQuery cache busters don't change the report.
+    get = sorted(u"%s=%s" % (key, value)
+                 for key, values in request.GET.lists()
+                 for value in values
+                 if key not in ("callback", "_"))
+    normalized = u"\n".join([unicode(part) for part in parts] + get)
+    digest = md5(normalized.encode("utf-8")).hexdigest()
+    return "crowdsourcing_report_%s" % digest
+
+
+def _report_versions(report_obj, surveys):
+    versions = [(survey.pk,
+                 survey.get_schema_version(),
+                 survey.get_data_version()) for survey in surveys]
+    if report_obj.pk:
+        versions.append(get_version("survey_report_%d" % report_obj.pk))
+    return versions
+
+
+def _cached_report(request, key, versions, render):
+    """ Return the rendered report cached under key if it's still fresh
+    for versions. Otherwise call render to make it again. While one process
+    re-renders a stale report, the rest keep serving the stale one. Only
+    anonymous users share cached reports, since the templates get a
+    RequestContext, and a page with a csrf token in it is never cached. """
+    timeout = crowdsourcing_settings.REPORT_CACHE_TIMEOUT
+    if not timeout or get_user(request).is_authenticated():
+        return render()
+    cached = cache.get(key)
+    lock_key = key + "_lock"
+    if cached:
+        cached_versions, fresh_until, content = cached
+        if cached_versions == versions and time.time() < fresh_until:
+            return content
+        if not cache.add(lock_key, True, _REPORT_RENDER_LOCK_TIMEOUT):
+            return content
+    try:
+        content = render()
+        # get_token sets CSRF_COOKIE_USED when a template asks for the token.
+        if not request.META.get("CSRF_COOKIE_USED"):
+            stale_timeout = (timeout +
+                             crowdsourcing_settings.REPORT_CACHE_MAX_STALE)
+            cache.set(key,
+                      (versions, time.time() + timeout, content),
+                      stale_timeout)
+    finally:
+        if cached:
+            cache.delete(lock_key)
+    return content
+
+
 def pages_to_link_from_paginator(page, paginator):
     """ Return an array with numbers where you should link to a page, and False
     where you should show elipses. For example, if you have 9 pages and you are
@@ -848,11 +1490,267 @@ def paginate_or_404(queryset, page, num_per_page=20):
     return paginator, page_obj
 
 
+def merge_submissions(querysets, keep_order=False):
+    """ All the submissions of querysets as one object that Paginator can
+    page through without loading more than the page it asks for. Normally
+    that's a single queryset, newest first. If keep_order is true, or some of
+    the querysets are sliced or aren't querysets at all, you get each
+    queryset's submissions in turn instead. """
+    querysets = list(querysets)
+    if not querysets:
+        return Submission.objects.none()
+    if 1 == len(querysets) and keep_order:
+        return querysets[0]
+    combine = not keep_order and all(
+        [hasattr(q, "query") and q.query.can_filter() for q in querysets])
+    if combine:
+        return reduce(operator.or_, querysets).order_by(*SUBMISSION_ORDER)
+    return SubmissionChain(querysets)
+
+
+class SubmissionChain(object):
+    """ Several lists or querysets of submissions one after another. Slicing
+    only loads the submissions in the slice. """
+    def __init__(self, querysets):
+        self._querysets = querysets
+        self._counts = None
+
+    def _get_counts(self):
+        if self._counts is None:
+            self._counts = []
+            for queryset in self._querysets:
+                try:
+                    self._counts.append(queryset.count())
+                except (AttributeError, TypeError):
+                    self._counts.append(len(queryset))
+        return self._counts
+
+    def count(self):
+        return sum(self._get_counts())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            found = self[index:index + 1]
+            if not found:
+                raise IndexError(index)
+            return found[0]
+        start, stop, step = index.indices(self.count())
+        found = []
+        offset = 0
+        for queryset, n in zip(self._querysets, self._get_counts()):
+            if start < offset + n and offset < stop:
+                found.extend(queryset[max(start - offset, 0):stop - offset])
+            offset += n
+        return found[::step]
+
+
+# Newest first, with the id breaking ties so that keyset pagination never
+# skips or repeats a submission.
+SUBMISSION_ORDER = ("-submitted_at", "-id")
+
+_CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(submission):
+    """ Where to pick up after submission in SUBMISSION_ORDER. """
+    submitted_at = submission.submitted_at
+    if timezone.is_aware(submitted_at):
+        submitted_at = timezone.make_naive(submitted_at, timezone.utc)
+    return "%s_%d" % (submitted_at.strftime(_CURSOR_DATE_FORMAT),
+                      submission.id)
+
+
+def decode_cursor(cursor):
+    """ Raises ValueError if this isn't a cursor from encode_cursor. """
+    submitted_at, id = cursor.rsplit("_", 1)
+    submitted_at = datetime.strptime(submitted_at, _CURSOR_DATE_FORMAT)
+    if settings.USE_TZ:
+        submitted_at = timezone.make_aware(submitted_at, timezone.utc)
+    return submitted_at, int(id)
+
+
+def keyset_filter(submissions, cursor, older=True):
+    """ The submissions older (or newer) than cursor, ordered moving away
+    from it. """
+    submitted_at, id = decode_cursor(cursor)
+    if older:
+        q = Q(submitted_at__lt=submitted_at)
+        q |= Q(submitted_at=submitted_at, id__lt=id)
+        return submissions.filter(q).order_by(*SUBMISSION_ORDER)
+    q = Q(submitted_at__gt=submitted_at)
+    q |= Q(submitted_at=submitted_at, id__gt=id)
+    return submissions.filter(q).order_by("submitted_at", "id")
+
+
+def _use_keyset_pagination(report_obj):
+    # PRE_REPORT may sort some other way, and reports limited to their top
+    # submissions are short anyway.
+    return all([crowdsourcing_settings.KEYSET_PAGINATION,
+                not crowdsourcing_settings.PRE_REPORT,
+                not report_obj.limit_results_to])
+
+
+class KeysetPage(object):
+    """ A page of submissions, newest first, that starts where the previous
+    page left off instead of at an offset. Deep pages cost no more than the
+    first, and nothing counts all the submissions unless you call count.
+    Templates can use it like a Page, except there are no page numbers. The
+    after and before query string parameters hold the cursors. """
+    is_keyset = True
+    number = None
+
+    def __init__(self, querysets, request, num_per_page=20):
+        self._querysets = list(querysets)
+        self._get = request.GET
+        after = request.GET.get("after", "")
+        before = request.GET.get("before", "")
+        try:
+            if before:
+                found = self._find(before, False, num_per_page)
+                self.object_list = found[:num_per_page][::-1]
+                self._has_previous = len(found) > num_per_page
+                self._has_next = True
+            else:
+                found = self._find(after, True, num_per_page)
+                self.object_list = found[:num_per_page]
+                self._has_previous = bool(after)
+                self._has_next = len(found) > num_per_page
+        except ValueError:
+            raise Http404
+
+    def _find(self, cursor, older, num_per_page):
+        # Merge one more than a page from each queryset so we know whether
+        # there's another page.
+        found = []
+        for queryset in self._querysets:
+            if cursor:
+                queryset = keyset_filter(queryset, cursor, older)
+            else:
+                queryset = queryset.order_by(*SUBMISSION_ORDER)
+            found.extend(queryset[:num_per_page + 1])
+        found.sort(key=lambda s: (s.submitted_at, s.id), reverse=older)
+        return found[:num_per_page + 1]
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def _query(self, key, submission):
+        get = self._get.copy()
+        get.pop("after", None)
+        get.pop("before", None)
+        get[key] = encode_cursor(submission)
+        return get.urlencode()
+
+    def next_query(self):
+        """ The query string for the next (older) page. """
+        return self._query("after", self.object_list[-1])
+
+    def previous_query(self):
+        return self._query("before", self.object_list[0])
+
+    def count(self):
+        """ The total number of submissions, cached for
+        CROWDSOURCING_KEYSET_COUNT_TIMEOUT seconds. """
+        queries = repr([q.query.sql_with_params() for q in self._querysets])
+        key = "crowdsourcing_count_%s" % md5(queries).hexdigest()
+        total = cache.get(key)
+        if total is None:
+            total = sum(queryset.count() for queryset in self._querysets)
+            timeout = crowdsourcing_settings.KEYSET_COUNT_TIMEOUT
+            cache.set(key, total, timeout)
+        return total
+
+
+def _location_question_results_versions(
+    request,
+    question_id,
+    limit_map_answers,
+    survey_report_slug=""):
+    survey = get_object_or_404(Survey.objects.filter(questions__pk=question_id))
+    return _survey_versions(survey, survey_report_slug)
+
+
+@conditional_get(_location_question_results_versions, cors=False)
 def location_question_results(
     request,
     question_id,
     limit_map_answers,
     survey_report_slug=""):
+    question, answers, limit_results_to = _map_answers(request,
+                                                       question_id,
+                                                       survey_report_slug)
+    limit_map_answers = int(limit_map_answers) if limit_map_answers else 0
+    if limit_map_answers or limit_results_to:
+        answers = answers[:min(filter(None, [limit_map_answers,
+                                             limit_results_to,]))]
+    response = HttpResponse(mimetype='application/json')
+    dump(_map_entries(question, answers, _wants_compact(request)), response)
+    return response
+
+
+def _location_question_tile_versions(request, question_id, z, x, y,
+                                     survey_report_slug=""):
+    return _location_question_results_versions(request,
+                                               question_id,
+                                               None,
+                                               survey_report_slug)
+
+
+@conditional_get(_location_question_tile_versions, cors=False)
+def location_question_tile(request, question_id, z, x, y,
+                           survey_report_slug=""):
+    """ The answers in Google Maps tile x, y at zoom z. If there are more
+    than CROWDSOURCING_MAP_TILE_POINTS of them, the entries are clusters
+    instead of points. Each cluster has the average lat and lng, and the
+    count, of the points in one cell of an 8 by 8 grid over the tile. At the
+    deepest zoom there is nothing left to split, so a busy tile is one
+    cluster. """
+    z, x, y = int(z), int(x), int(y)
+    if z > QUADKEY_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404
+    question, answers, limit_results_to = _map_answers(request,
+                                                       question_id,
+                                                       survey_report_slug)
+    answers = answers.filter(quadkey__startswith=tile_quadkey(x, y, z))
+    answers = answers.exclude(quadkey="")
+    max_points = crowdsourcing_settings.MAP_TILE_POINTS
+    cell_zoom = min(z + 3, QUADKEY_ZOOM)
+    compact = _wants_compact(request)
+    # Ordering would make the database sort every answer in the tile just
+    # to see if there are too many.
+    points = list(answers.order_by()[:max_points + 1])
+    if len(points) <= max_points:
+        data = _map_entries(question, points, compact)
+    elif cell_zoom == z:
+        tile = answers.order_by().aggregate(count=Count("id"),
+                                            lat=Avg("latitude"),
+                                            lng=Avg("longitude"))
+        data = {"entries": [tile]}
+    else:
+        cells = answers.order_by().extra(
+            select={"cell": "SUBSTR(quadkey, 1, %d)" % cell_zoom})
+        cells = cells.values("cell").annotate(count=Count("id"),
+                                              lat=Avg("latitude"),
+                                              lng=Avg("longitude"))
+        data = {"entries": [dict(lat=c["lat"], lng=c["lng"], count=c["count"])
+                            for c in cells]}
+    response = HttpResponse(mimetype='application/json')
+    dump(data, response)
+    return response
+
+
+def _map_answers(request, question_id, survey_report_slug):
+    """ The question, its answers with coordinates that the user may see
+    newest first, and the report's limit on how many to show. """
     question = get_object_or_404(Question.objects.select_related("survey"),
                                  pk=question_id,
                                  answer_is_public=True)
@@ -866,19 +1764,6 @@ def location_question_results(
                                           slug=survey_report_slug)
         featured = survey_report.featured
         limit_results_to = survey_report.limit_results_to
-    icon_lookup = {}
-    icon_questions = question.survey.icon_questions()
-    for icon_question in icon_questions:
-        icon_by_answer = {}
-        for (option, icon) in icon_question.parsed_option_icon_pairs():
-            if icon:
-                icon_by_answer[option] = icon
-        answer_set = icon_question.answer_set.all()
-        for answer in answer_set.select_related("question"):
-            if answer.value in icon_by_answer:
-                icon = icon_by_answer[answer.value]
-                icon_lookup[answer.submission_id] = icon
-
     answers = question.answer_set.filter(
         ~Q(latitude=None),
         ~Q(longitude=None)).order_by("-submission__submitted_at")
@@ -891,24 +1776,82 @@ def location_question_results(
         "submission_id",
         question.survey,
         request.GET)
-    limit_map_answers = int(limit_map_answers) if limit_map_answers else 0
-    if limit_map_answers or limit_results_to:
-        answers = answers[:min(filter(None, [limit_map_answers,
-                                             limit_results_to,]))]
+    return question, answers, limit_results_to
+
+
+def _wants_compact(request):
+    return request.GET.get("compact", "").lower() in ("1", "true")
+
+
+def _map_entries(question, answers, compact=False):
+    """ The map JSON for answers. Normally that's an "entries" list with the
+    lat, lng, url, and icon of each point. If compact is true, it's
+    parallel "ids", "lat", "lng", and "icon" lists instead, where each icon
+    is an index into the "icons" list, and the url is "url" with the id in
+    place of {id}. """
+    answers = list(answers)
+    icon_lookup = _icon_lookup(question.survey,
+                               [a.submission_id for a in answers])
+    url = _submission_for_map_url()
+    if compact:
+        icons = []
+        icon_indexes = {}
+        for icon in icon_lookup.values():
+            if icon not in icon_indexes:
+                icon_indexes[icon] = len(icons)
+                icons.append(icon)
+        return {
+            "url": url,
+            "ids": [a.submission_id for a in answers],
+            "lat": [a.latitude for a in answers],
+            "lng": [a.longitude for a in answers],
+            "icons": icons,
+            "icon": [icon_indexes.get(icon_lookup.get(a.submission_id))
+                     for a in answers]}
     entries = []
-    view = "crowdsourcing.views.submission_for_map"
     for answer in answers:
-        kwargs = {"id": answer.submission_id}
         d = {
             "lat": answer.latitude,
             "lng": answer.longitude,
-            "url": reverse(view, kwargs=kwargs)}
+            "url": url.replace("{id}", str(answer.submission_id))}
         if answer.submission_id in icon_lookup:
             d["icon"] = icon_lookup[answer.submission_id]
         entries.append(d)
-    response = HttpResponse(mimetype='application/json')
-    dump({"entries": entries}, response)
-    return response
+    return {"entries": entries}
+
+
+def _submission_for_map_url():
+    """ submission_for_map's url with {id} in place of the id, since
+    reversing it for every point of a big map adds up. """
+    placeholder = 1234567890
+    url = reverse("crowdsourcing.views.submission_for_map",
+                  kwargs={"id": placeholder})
+    return url.replace(str(placeholder), "{id}")
+
+
+def _icon_lookup(survey, submission_ids):
+    """ submission id -> map icon for the submissions among submission_ids
+    whose answer to an icon question has an icon. Later icon questions win.
+    """
+    icon_lookup = {}
+    for icon_question in survey.icon_questions():
+        icon_by_option = icon_question.icon_by_option
+        if not icon_by_option:
+            continue
+        column = icon_question.value_column
+        # Chunks keep us under SQLite's limit on query parameters.
+        for i in range(0, len(submission_ids), 500):
+            answers = icon_question.answer_set.filter(
+                submission__in=submission_ids[i:i + 500])
+            if "text_answer" == column:
+                answers = answers.filter(text_answer__in=icon_by_option.keys())
+            answers = answers.values_list("submission_id", column)
+            for submission_id, value in answers.order_by():
+                icon = icon_by_option.get(value)
+                if icon:
+                    icon_lookup[submission_id] = icon
+    return icon_lookup
+
 
 def location_question_map(
     request,